@@ -37,6 +37,7 @@ warnings.resetwarnings()
 import mimetypes
 
 from pyramid.config import Configurator
+from pyramid.tweens import EXCVIEW
 from pyramid.authorization import ACLAuthorizationPolicy
 from pyramid_beaker import session_factory_from_settings
 from pyramid_mailer import mailer_factory_from_settings
@@ -44,7 +45,11 @@ from sqlalchemy import engine_from_config
 
 from samplesdb.models import DBSession
 from samplesdb.licenses import licenses_factory_from_settings
+from samplesdb.sendfile import file_sender_from_settings
+from samplesdb.exports import export_jobs_from_settings
+from samplesdb.workers import worker_pools_from_settings
 from samplesdb.authentication import authentication_policy_from_settings
+from samplesdb.views import compile_templates
 from samplesdb.security import (
     get_user,
     group_finder,
@@ -79,6 +84,11 @@ ROUTES = {
     'collections_view':            r'/collections/{collection_id:\d+}',
     'collections_edit':            r'/collections/{collection_id:\d+}/edit',
     'collections_export':          r'/collections/{collection_id:\d+}/export',
+    'collections_import':          r'/collections/{collection_id:\d+}/import',
+    'collections_export_job':      r'/collections/{collection_id:\d+}/export/{job_id:[a-f0-9]+}',
+    'collections_export_status':   r'/collections/{collection_id:\d+}/export/{job_id:[a-f0-9]+}/status',
+    'collections_export_download': r'/collections/{collection_id:\d+}/export/{job_id:[a-f0-9]+}/download',
+    'collections_thumbs':          r'/collections/{collection_id:\d+}/thumbs',
     'collections_destroy':         r'/collections/{collection_id:\d+}/destroy',
     'samples_create':              r'/collections/{collection_id:\d+}/new',
     'samples_combine':             r'/collections/{collection_id:\d+}/combine',
@@ -93,6 +103,9 @@ ROUTES = {
     'samples_default_attachment':  r'/samples/{sample_id:\d+}/default-attachment',
     'samples_download_attachment': r'/samples/{sample_id:\d+}/download-attachment',
     'samples_attachment_thumb':    r'/samples/{sample_id:\d+}/thumb/{attachment}',
+    'samples_uploads':             r'/samples/{sample_id:\d+}/uploads',
+    'samples_upload':              r'/samples/{sample_id:\d+}/uploads/{upload_id:[a-f0-9]+}',
+    'samples_upload_commit':       r'/samples/{sample_id:\d+}/uploads/{upload_id:[a-f0-9]+}/commit',
     # views.admin
     'admin_home':                  r'/admin/',
     'admin_users':                 r'/admin/users/',
@@ -119,6 +132,12 @@ def main(global_config, **settings):
     session_factory = session_factory_from_settings(settings)
     mailer_factory = mailer_factory_from_settings(settings)
     licenses_factory = licenses_factory_from_settings(settings)
+    file_sender = file_sender_from_settings(settings)
+    worker_pools = worker_pools_from_settings(settings)
+    # Fork the worker processes before anything (the server included) starts
+    # threads
+    worker_pools.start()
+    export_jobs = export_jobs_from_settings(settings)
     authn_policy = authentication_policy_from_settings(settings)
     authz_policy = ACLAuthorizationPolicy()
     engine = engine_from_config(settings, 'sqlalchemy.')
@@ -132,10 +151,18 @@ def main(global_config, **settings):
         session_factory=session_factory)
     config.registry['mailer'] = mailer_factory
     config.registry['licenses'] = licenses_factory
+    config.registry['sendfile'] = file_sender
+    config.registry['workers'] = worker_pools
+    config.registry['exports'] = export_jobs
     # XXX Deprecated in 1.4
     config.set_request_property(get_user, b'user', reify=True)
     # XXX For 1.4:
     #config.add_request_method(get_user, b'user', reify=True)
+    # The quota tween must run within the transaction, as it loads the user
+    # that the views will go on to use
+    config.add_tween(
+        'samplesdb.uploads.quota_tween_factory',
+        under=('pyramid_tm.tm_tween_factory', EXCVIEW))
     config.add_static_view('static', 'static', cache_max_age=3600)
     for name, url in ROUTES.items():
         if '{collection_id:' in url:
@@ -147,6 +174,10 @@ def main(global_config, **settings):
         config.add_route(name, url, factory=factory)
     config.scan()
     app = config.make_wsgi_app()
+    # Compile templates now rather than on the first request to use each
+    # one (renderer factories are only registered once the configuration
+    # has been committed by make_wsgi_app)
+    compile_templates(config.registry, settings.get('templates.cache_dir'))
     # XXX Dirty horrid hack for functional testing
     if settings.get('testing', '0') == '1':
         app.engine = engine
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012 Dave Hughes.
+#
+# This file is part of samplesdb.
+#
+# samplesdb is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# samplesdb is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# samplesdb.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Provides a content-addressed store for attachment content.
+
+Each distinct piece of content is stored once as a "blob" named by its SHA-256
+digest, in a directory sharded by the first two pairs of hex digits of the
+digest. The names under which attachments appear in a sample are hard-links
+to these blobs, hence the file-system's link count serves as the blob's
+reference count: a blob with a link count of 1 is referenced by no sample and
+can be collected.
+
+Blobs may also be stored compressed, in which case their names carry a
+".gz" suffix; the digest is always that of the uncompressed content.
+"""
+
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+    division,
+    )
+
+import os
+import io
+import time
+import errno
+import shutil
+import hashlib
+import tempfile
+from contextlib import closing
+
+from samplesdb.compress import GzipWriter
+
+
+__all__ = ['BlobStore', 'copy_file']
+
+
+def copy_file(source, target):
+    """Copies source to target, in kernel space where possible"""
+    if not hasattr(os, 'sendfile'):
+        shutil.copyfile(source, target)
+        return
+    with io.open(source, 'rb') as src:
+        with io.open(target, 'wb') as dest:
+            remaining = os.fstat(src.fileno()).st_size
+            offset = 0
+            while remaining > 0:
+                sent = os.sendfile(dest.fileno(), src.fileno(), offset, remaining)
+                if not sent:
+                    break
+                offset += sent
+                remaining -= sent
+
+
+class BlobStore(object):
+    """Stores file content under its SHA-256 digest"""
+
+    block_size = 1024**2
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, name):
+        """Returns the filename of the blob with the specified name"""
+        return os.path.join(self.root, name[:2], name[2:4], name)
+
+    def _marker(self, name):
+        """Returns the filename of the blob's grace period marker"""
+        return self.path(name) + '.stored'
+
+    def __contains__(self, name):
+        return os.path.exists(self.path(name))
+
+    def __iter__(self):
+        if os.path.exists(self.root):
+            for dirpath, dirnames, filenames in os.walk(self.root):
+                for filename in filenames:
+                    if len(filename) == 64 or (
+                            len(filename) == 67 and filename.endswith('.gz')):
+                        yield filename
+
+    def store(self, file_obj, compress=False):
+        """
+        Stores the content of a file-like object, returning a tuple of the
+        blob's name and its size on disk.
+
+        The content is hashed and measured as it is copied into the store. If
+        compress is True the content is gzip compressed as it is copied. If a
+        blob with the same name already exists, the copy is discarded.
+        """
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        tempfd, temppath = tempfile.mkstemp(dir=self.root)
+        try:
+            digest = hashlib.sha256()
+            with closing(os.fdopen(tempfd, 'wb')) as f:
+                target = GzipWriter(f) if compress else f
+                while True:
+                    data = file_obj.read(self.block_size)
+                    if not data:
+                        break
+                    digest.update(data)
+                    target.write(data)
+                if compress:
+                    target.close()
+            name = digest.hexdigest() + ('.gz' if compress else '')
+            size = os.stat(temppath).st_size
+            self._insert(temppath, name)
+        except:
+            if os.path.exists(temppath):
+                os.unlink(temppath)
+            raise
+        return name, size
+
+    def store_file(self, filename, compress=False):
+        """
+        Moves the file filename into the store, returning a tuple of the
+        blob's name and its size on disk.
+
+        The file's content is read once to hash it, but is never copied when
+        filename lies on the same file-system as the store; it is simply
+        renamed into place. Otherwise it is copied with sendfile where
+        available. If a blob with the same content already exists, filename
+        is simply removed. If compress is True, the content must be copied
+        to compress it, after which filename is removed.
+        """
+        if compress:
+            with io.open(filename, 'rb') as f:
+                result = self.store(f, compress=True)
+            os.unlink(filename)
+            return result
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        digest = hashlib.sha256()
+        size = 0
+        with io.open(filename, 'rb') as f:
+            while True:
+                data = f.read(self.block_size)
+                if not data:
+                    break
+                digest.update(data)
+                size += len(data)
+        digest = digest.hexdigest()
+        tempfd, temppath = tempfile.mkstemp(dir=self.root)
+        os.close(tempfd)
+        try:
+            try:
+                os.rename(filename, temppath)
+            except OSError, exc:
+                if exc.errno != errno.EXDEV:
+                    raise
+                copy_file(filename, temppath)
+                os.unlink(filename)
+            self._insert(temppath, digest)
+        except:
+            if os.path.exists(temppath):
+                os.unlink(temppath)
+            raise
+        return digest, size
+
+    def _insert(self, temppath, name):
+        """Moves the file at temppath into the store as name"""
+        blob = self.path(name)
+        if os.path.exists(blob):
+            os.unlink(temppath)
+            # The existing blob may be unreferenced and due for collection
+            # before the caller links it. Its own times can't be touched to
+            # prevent this, as they're shared by every attachment linked to
+            # it, so a marker beside it records that it was just stored
+            marker = self._marker(name)
+            with io.open(marker, 'ab'):
+                pass
+            os.utime(marker, None)
+        else:
+            path = os.path.dirname(blob)
+            if not os.path.exists(path):
+                os.makedirs(path)
+            os.rename(temppath, blob)
+
+    def link(self, name, filename):
+        """
+        Atomically makes filename refer to the blob with the specified name,
+        replacing filename if it already exists.
+        """
+        self.link_file(self.path(name), filename)
+
+    @staticmethod
+    def link_file(source, filename):
+        """
+        Atomically makes filename a hard-link of source, replacing filename if
+        it already exists. If a link cannot be created (e.g. because the two
+        lie on different file-systems, or because the source's link limit is
+        reached) source is copied instead.
+        """
+        path = os.path.dirname(filename)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        tempfd, temppath = tempfile.mkstemp(dir=path)
+        os.close(tempfd)
+        os.unlink(temppath)
+        try:
+            try:
+                os.link(source, temppath)
+            except (OSError, AttributeError):
+                copy_file(source, temppath)
+            os.rename(temppath, filename)
+        except:
+            if os.path.exists(temppath):
+                os.unlink(temppath)
+            raise
+
+    def references(self, name):
+        """Returns the number of attachments referencing the blob"""
+        return os.stat(self.path(name)).st_nlink - 1
+
+    def collect(self, grace=0, dry_run=False):
+        """
+        Removes (or with dry_run, finds) all unreferenced blobs, returning the
+        bytes reclaimable.
+
+        Blobs whose status has changed, or which have been stored again,
+        within the last ``grace`` seconds are left alone to avoid racing with
+        an upload that has stored a blob but not yet linked it.
+        """
+        result = 0
+        threshold = time.time() - grace
+        for name in list(self):
+            blob = self.path(name)
+            marker = self._marker(name)
+            try:
+                if os.path.exists(marker):
+                    if os.stat(marker).st_mtime >= threshold:
+                        continue
+                    if not dry_run:
+                        os.unlink(marker)
+                stat = os.stat(blob)
+                if stat.st_nlink == 1 and stat.st_ctime < threshold:
+                    if not dry_run:
+                        os.unlink(blob)
+                    result += stat.st_size
+            except OSError, exc:
+                if exc.errno != errno.ENOENT:
+                    raise
+        return result
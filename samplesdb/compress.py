@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012 Dave Hughes.
+#
+# This file is part of samplesdb.
+#
+# samplesdb is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# samplesdb is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# samplesdb.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Provides routines for storing attachment content compressed.
+
+Compressed content is stored in the gzip format so that it can be transmitted
+as-is to clients which accept the gzip content-encoding. To distinguish
+content compressed by the application from attachments which simply happen to
+be gzip files, the gzip header carries an "extra" field with a subfield
+identifying samplesdb (which is permitted, and ignored, by all gzip readers).
+"""
+
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+    division,
+    )
+
+import io
+import zlib
+import gzip
+import struct
+
+__all__ = [
+    'can_compress',
+    'is_compressed',
+    'open_compressed',
+    'GzipWriter',
+    ]
+
+COMPRESSIBLE_MIME_TYPES = set((
+    'application/javascript',
+    'application/json',
+    'application/postscript',
+    'application/rtf',
+    'application/xml',
+    'application/x-latex',
+    'application/x-sh',
+    'application/x-tex',
+    ))
+
+# Header of a gzip stream with FLG.FEXTRA set, a zero modification time and
+# unknown OS, followed by an extra field consisting of a single empty
+# subfield with the ID "SD"
+GZIP_HEADER = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x04\x00SD\x00\x00'
+
+
+def can_compress(mime_type):
+    "Returns True if the specified MIME type is worth compressing"
+    # Images are excluded as even the uncompressed formats are used directly
+    # for thumbnails
+    return (
+        mime_type.startswith('text/') or
+        mime_type.endswith('+xml') and not mime_type.startswith('image/') or
+        mime_type in COMPRESSIBLE_MIME_TYPES)
+
+def is_compressed(filename):
+    "Returns True if the file was compressed by GzipWriter"
+    with io.open(filename, 'rb') as f:
+        return f.read(len(GZIP_HEADER)) == GZIP_HEADER
+
+def open_compressed(filename):
+    "Returns a file-like object reading the content of a compressed file"
+    return gzip.GzipFile(filename, 'rb')
+
+
+class GzipWriter(object):
+    """Write-only file-like object which gzip compresses to file_obj"""
+
+    def __init__(self, file_obj, level=6):
+        self.file_obj = file_obj
+        self.size = 0
+        self.crc = zlib.crc32(b'') & 0xffffffff
+        self.compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -zlib.MAX_WBITS, zlib.DEF_MEM_LEVEL, 0)
+        self.file_obj.write(GZIP_HEADER)
+
+    def write(self, data):
+        self.size += len(data)
+        self.crc = zlib.crc32(data, self.crc) & 0xffffffff
+        self.file_obj.write(self.compressor.compress(data))
+
+    def close(self):
+        """Writes the remaining compressed data and the trailer"""
+        self.file_obj.write(self.compressor.flush())
+        self.file_obj.write(struct.pack(
+            b'<II', self.crc, self.size & 0xffffffff))
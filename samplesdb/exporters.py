@@ -24,16 +24,28 @@ from __future__ import (
     division,
     )
 
+import re
 import csv
-from datetime import datetime
+import json
+from datetime import date, datetime
+from itertools import islice, groupby
+from operator import itemgetter
 
-from sqlalchemy.orm import aliased
+import xlwt
+from sqlalchemy import func, cast, select, literal_column
+from sqlalchemy.types import Date, DateTime, Integer, String, Unicode
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 from samplesdb.models import (
     DBSession,
-    Collection,
     Sample,
     SampleCode,
+    SampleOrigin,
     )
 
 
@@ -44,22 +56,334 @@ def invert_map(m):
     return dict(zip(m.values(), m.keys()))
 
 
-class CollectionCsvExporter(object):
+def stream(query, batch_size):
     """
-    CSV Exporter class for collections.
+    Yields the rows of query, executed with a server-side cursor where the
+    database supports it so that rows are fetched batch_size at a time rather
+    than all at once
+    """
+    # Only plain columns are queried, so the statement is executed directly
+    # avoiding the overhead of the ORM's row processing
+    result = DBSession.execute(
+        query.statement.execution_options(stream_results=True))
+    try:
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        result.close()
+
+
+def copy_supported():
+    """
+    Returns True if the session's database supports COPY through its driver
+    """
+    dialect = DBSession.get_bind().dialect
+    return dialect.name == 'postgresql' and dialect.driver == 'psycopg2'
+
+
+# Maps the strftime directives which PostgreSQL's to_char reproduces exactly
+# to their to_char equivalents
+TO_CHAR_MAP = {
+    '%Y': 'YYYY',
+    '%y': 'YY',
+    '%m': 'MM',
+    '%d': 'DD',
+    '%j': 'DDD',
+    '%H': 'HH24',
+    '%I': 'HH12',
+    '%M': 'MI',
+    '%S': 'SS',
+    '%%': '"%"',
+    }
+
+
+def to_char_format(dateformat):
+    """
+    Returns the PostgreSQL to_char format equivalent to the strftime
+    dateformat, or None if it has no exact equivalent
+    """
+    result = []
+    for index, part in enumerate(re.split(r'(%.)', dateformat)):
+        if index % 2:
+            if not part in TO_CHAR_MAP:
+                return None
+            result.append(TO_CHAR_MAP[part])
+        elif part:
+            # Literal text is quoted so that to_char doesn't mistake any of
+            # it for patterns
+            result.append('"%s"' % (
+                part.replace('\\', '\\\\').replace('"', '\\"')))
+    return ''.join(result)
+
+
+class NewlineTranslator(object):
+    """
+    Wraps a file-like object to which CSV is written, translating the newlines
+    terminating its records into lineterminator. Newlines within quoted fields
+    are left alone, as csv.writer leaves them; quotes within fields must be
+    doubled.
+    """
+
+    def __init__(self, output_file, lineterminator, quotechar=b'"'):
+        self._file = output_file
+        self._lineterminator = lineterminator
+        self._quotechar = quotechar
+        self._quoted = False
+
+    def write(self, data):
+        # Splitting on the quote character alternates between text outside
+        # and inside quotes (a doubled quote merely leaves and re-enters)
+        parts = data.split(self._quotechar)
+        for index, part in enumerate(parts):
+            if self._quoted == bool(index % 2):
+                parts[index] = part.replace(b'\n', self._lineterminator)
+        if len(parts) % 2 == 0:
+            self._quoted = not self._quoted
+        self._file.write(self._quotechar.join(parts))
+
+
+class OrderedLookup(object):
+    """
+    Looks up values in an iterable of (key, value) tuples ordered by key.
+
+    Keys must be looked up in ascending order; each lookup consumes the
+    iterable up to the requested key, so the whole iterable is read once (and
+    not at all until the first lookup). Keys which do not appear in the
+    iterable produce ``default``.
+    """
+
+    def __init__(self, iterable, default=None):
+        self._iterable = iterable
+        self._iter = None
+        self._current = None
+        self.default = default
+
+    def __getitem__(self, key):
+        if self._iter is None:
+            self._iter = iter(self._iterable)
+            self._current = next(self._iter, None)
+        while self._current is not None and self._current[0] < key:
+            self._current = next(self._iter, None)
+        if self._current is not None and self._current[0] == key:
+            return self._current[1]
+        return self.default
+
+
+class CollectionExporter(object):
+    """
+    Base class for collection exporters.
 
     `collection` : the collection to be exported
 
     After construction, the ``all_columns`` property will be a map of column
     identifier to column description. The ``columns`` property will be an
     ordered sequence of column identifiers selected for export which should be
-    modified according to user preference.
+    modified according to user preference. The ``exported`` property counts
+    the samples exported so far.
+
+    Descendants must provide ``title``, ``content_type`` and ``extension``
+    attributes, and an ``export`` method.
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.exported = 0
+        self.all_columns = [
+            ('id'          , 'Identifier')  , 
+            ('description' , 'Description') , 
+            ('created'     , 'Created')     , 
+            ('destroyed'   , 'Destroyed')   , 
+            ('location'    , 'Location')    , 
+            ('parents'     , 'Parents')     , 
+            ('children'    , 'Children')    , 
+            ]
+        self.all_columns.extend(
+            ('code_' + name, name) for name in collection.code_names)
+        self.columns = [name for (name, title) in self.all_columns]
+        self.all_columns = dict(self.all_columns)
+
+    def _query(self):
+        """
+        Returns the query producing the id of each of the collection's
+        samples, followed by its selected columns of the samples table,
+        ordered by id
+        """
+        # The id is labelled so that it isn't merged with an "id" column
+        # selected for export when the statement is executed
+        return DBSession.query(Sample.id.label('sample_id'), *(
+                Sample.__table__.columns[column]
+                for column in self.columns
+                if not column.startswith('code_')
+                and not column in ('parents', 'children')
+                )).\
+            filter(Sample.collection_id==self.collection.id).\
+            order_by(Sample.id)
+
+    def _codes(self, names):
+        """
+        Returns a query producing (sample_id, name, value) tuples for the
+        named codes of the collection's samples, ordered by sample_id
+        """
+        return DBSession.query(
+                SampleCode.sample_id, SampleCode.name, SampleCode.value).\
+            join(Sample).\
+            filter(Sample.collection_id==self.collection.id).\
+            filter(SampleCode.name.in_(names)).\
+            order_by(SampleCode.sample_id)
+
+    def _lineage(self, column):
+        """
+        Returns a query producing (sample_id, lineage_id) tuples for the
+        parents or children (according to column) of the collection's samples,
+        ordered by sample_id and lineage_id
+        """
+        key, other = {
+            'parents':  (SampleOrigin.sample_id, SampleOrigin.parent_id),
+            'children': (SampleOrigin.parent_id, SampleOrigin.sample_id),
+            }[column]
+        return DBSession.query(
+                key.label('sample_id'), other.label('lineage_id')).\
+            join(Sample, Sample.id==key).\
+            filter(Sample.collection_id==self.collection.id).\
+            order_by(key, other)
+
+    def _aggregate(self, lineage):
+        """
+        Returns a query producing (sample_id, ids) tuples from the lineage
+        query, where ids is the space separated list of each sample's lineage
+        ids, ordered by sample_id. Returns None if the database has no suitable
+        aggregate function
+        """
+        dialect = DBSession.get_bind().dialect
+        ordered = lineage.subquery('lineage')
+        if dialect.name == 'sqlite':
+            # SQLite's group_concat can't be ordered, but in practice lists
+            # the ids in the order of the ordered sub-query
+            aggregate = func.group_concat(
+                cast(ordered.c.lineage_id, Unicode), ' ')
+        elif dialect.name == 'postgresql' and (
+                dialect.server_version_info >= (9, 0)):
+            # PostgreSQL makes no such promise, so the aggregate is ordered
+            # explicitly; SQLAlchemy can't express this, hence the literal SQL
+            aggregate = literal_column(
+                "string_agg(CAST(lineage.lineage_id AS TEXT), ' ' "
+                "ORDER BY lineage.lineage_id)")
+        else:
+            return None
+        return DBSession.query(ordered.c.sample_id, aggregate).\
+            group_by(ordered.c.sample_id).\
+            order_by(ordered.c.sample_id)
+
+    def _formatters(self, query):
+        """
+        Returns a list of (index, function) tuples for the columns of query
+        whose values must be converted for output
+        """
+        return []
+
+    def _lineage_lists(self, rows):
+        """
+        Yields rows with the space separated ids of their lineage columns
+        converted to lists of integers
+        """
+        indexes = [
+            index for (index, column) in enumerate(self.columns)
+            if column in ('parents', 'children')]
+        for row in rows:
+            for index in indexes:
+                row[index] = [int(s) for s in (row[index] or '').split()]
+            yield row
+
+    def _rows(self, batch_size=1000):
+        """
+        Returns an iterator of the formatted rows of the export, fetched from
+        the database batch_size at a time.
+
+        The queries are constructed immediately but only executed as the
+        iterator is consumed.
+        """
+        query = self._query()
+        formatters = dict(self._formatters(query))
+        names = []
+        getters = []
+        cursors = []
+        index = 1
+        for column in self.columns:
+            if column.startswith('code_'):
+                name = column[len('code_'):]
+                names.append(name)
+                getters.append(lambda row, codes, name=name: codes.get(name))
+            elif column in ('parents', 'children'):
+                # Like codes, lineage is merged from a cursor ordered by
+                # sample id, aggregated by the database where possible
+                lineage = self._lineage(column)
+                aggregate = self._aggregate(lineage)
+                if aggregate is not None:
+                    lineage_rows = stream(aggregate, batch_size)
+                    lookup = OrderedLookup(lineage_rows)
+                else:
+                    lineage_rows = stream(lineage, batch_size)
+                    lookup = OrderedLookup(
+                        (sample_id, ' '.join(
+                            str(lineage_id) for (_, lineage_id) in rows))
+                        for (sample_id, rows) in groupby(
+                            lineage_rows, key=itemgetter(0)))
+                cursors.append(lineage_rows)
+                getters.append(
+                    lambda row, codes, lookup=lookup: lookup[row[0]])
+            elif index in formatters:
+                getters.append(
+                    lambda row, codes, index=index, format=formatters[index]:
+                    format(row[index]))
+                index += 1
+            else:
+                getters.append(lambda row, codes, index=index: row[index])
+                index += 1
+        # Codes are merged with the samples from a second cursor ordered by
+        # sample id; this costs one pass over sample_codes regardless of the
+        # number of codes, where a join per code is planned poorly
+        code_rows = stream(self._codes(names), batch_size) if names else []
+        if names:
+            cursors.append(code_rows)
+        codes = OrderedLookup((
+            (sample_id, dict((name, value) for (_, name, value) in rows))
+            for (sample_id, rows) in groupby(code_rows, key=itemgetter(0))
+            ), default={})
+        def generate():
+            try:
+                for row in stream(query, batch_size):
+                    sample_codes = codes[row[0]]
+                    yield [getter(row, sample_codes) for getter in getters]
+                    self.exported += 1
+            finally:
+                for cursor in cursors:
+                    cursor.close()
+        return generate()
+
+
+class CollectionCsvExporter(CollectionExporter):
+    """
+    CSV Exporter class for collections.
+
+    `collection` : the collection to be exported
 
     HTML-form friendly variants of the properties of the csv ``Dialect`` class
     are provided in ``delimiter``, ``lineterminator``, ``quotechar`` and so on.
     They default to the values of the Excel dialect.
+
+    On PostgreSQL (with psycopg2) ``export`` has the server produce the CSV
+    with COPY, provided the selected dialect and ``dateformat`` can be
+    expressed by it, unless ``fast_path`` is False.
     """
 
+    title = 'CSV'
+    content_type = 'text/csv'
+    extension = 'csv'
+
     _delimiter_map = {
         b',':  'comma',
         b';':  'semi-colon',
@@ -91,34 +415,114 @@ class CollectionCsvExporter(object):
     _quoting_inv = invert_map(_quoting_map)
 
     def __init__(self, collection):
-        self.collection = collection
+        super(CollectionCsvExporter, self).__init__(collection)
         self.delimiter = self._delimiter_map[csv.excel.delimiter]
         self.lineterminator = self._lineterminator_map[csv.excel.lineterminator]
         self.quotechar = self._quotechar_map[csv.excel.quotechar]
         self.quoting = self._quoting_map[csv.excel.quoting]
         self.doublequote = csv.excel.doublequote
         self.dateformat = '%Y-%m-%d'
-        self.all_columns = [
-            ('id'          , 'Identifier')  , 
-            ('description' , 'Description') , 
-            ('created'     , 'Created')     , 
-            ('destroyed'   , 'Destroyed')   , 
-            ('location'    , 'Location')    , 
-            # XXX Figure out a reasonable cross-database way of including this
-            # (SQLite supports GROUP_CONCAT, PostgreSQL has a string_agg but
-            # only in 9+, or we could use Python expressions if we don't care
-            # about efficieny...)
-            #('parents'     , 'Parents')     , 
-            #('children'    , 'Children')    , 
+        self.fast_path = True
+
+    def _writer(self, output_file):
+        """Returns a csv writer configured with the selected dialect"""
+        return csv.writer(output_file,
+            delimiter=self._delimiter_inv[self.delimiter],
+            lineterminator=self._lineterminator_inv[self.lineterminator],
+            quotechar=self._quotechar_inv[self.quotechar],
+            quoting=self._quoting_inv[self.quoting],
+            doublequote=self.doublequote)
+
+    def _formatters(self, query):
+        """
+        Returns a list of (index, function) tuples for the columns of query
+        whose values must be converted for output
+        """
+        dateformat = self.dateformat
+        def format_date(value):
+            # Rewrite the format of datetime values to exclude microseconds
+            # (which confuse several spreadsheet parsers and which it's
+            # unlikely anyone cares about)
+            if value is not None:
+                return value.strftime(dateformat)
+        return [
+            (index, format_date)
+            for (index, column) in enumerate(query.column_descriptions)
+            if isinstance(column['type'], (Date, DateTime))
             ]
-        self.all_columns.extend(
-            DBSession.query('code_' + SampleCode.name, SampleCode.name).\
-                join(Sample).\
-                join(Collection).\
-                filter(Collection.id==collection.id).\
-                distinct().all())
-        self.columns = [name for (name, title) in self.all_columns]
-        self.all_columns = dict(self.all_columns)
+
+    def _copy_supported(self):
+        """Returns True if the export can be performed with COPY"""
+        return (
+            self.fast_path and copy_supported()
+            and self._quoting_inv[self.quoting] == csv.QUOTE_MINIMAL
+            and self.doublequote
+            and to_char_format(self.dateformat) is not None)
+
+    def _copy_query(self):
+        """
+        Returns a select producing the selected columns of the collection's
+        samples formatted as the CSV writer would format them, ordered by id
+        """
+        samples = Sample.__table__
+        origins = SampleOrigin.__table__
+        dateformat = to_char_format(self.dateformat)
+        columns = []
+        for column in self.columns:
+            if column.startswith('code_'):
+                columns.append(func.nullif(
+                    select([SampleCode.__table__.c.value]).
+                    where(SampleCode.__table__.c.sample_id==samples.c.id).
+                    where(SampleCode.__table__.c.name==column[len('code_'):]).
+                    as_scalar(), ''))
+            elif column in ('parents', 'children'):
+                key, other = {
+                    'parents':  ('sample_id', 'parent_id'),
+                    'children': ('parent_id', 'sample_id'),
+                    }[column]
+                # SQLAlchemy can't express an ordered aggregate, hence the
+                # literal SQL
+                columns.append(literal_column(
+                    "(SELECT string_agg(CAST(o.%(other)s AS TEXT), ' ' "
+                    "ORDER BY o.%(other)s) FROM %(origins)s o "
+                    "WHERE o.%(key)s = %(samples)s.id)" % dict(
+                        key=key, other=other,
+                        origins=origins.name, samples=samples.name)))
+            elif isinstance(samples.c[column].type, (Date, DateTime)):
+                columns.append(func.to_char(samples.c[column], dateformat))
+            elif isinstance(samples.c[column].type, String):
+                # COPY quotes empty strings to distinguish them from NULL,
+                # which the CSV writer doesn't
+                columns.append(func.nullif(samples.c[column], ''))
+            else:
+                columns.append(samples.c[column])
+        return select(columns).\
+            where(samples.c.collection_id==self.collection.id).\
+            order_by(samples.c.id)
+
+    def _copy(self, output_file):
+        """Exports the collection to output_file with COPY"""
+        query = self._copy_query().compile(
+            dialect=DBSession.get_bind().dialect)
+        lineterminator = self._lineterminator_inv[self.lineterminator]
+        if lineterminator != b'\n':
+            output_file = NewlineTranslator(
+                output_file, lineterminator,
+                self._quotechar_inv[self.quotechar])
+        # COPY doesn't accept parameters, so the driver renders them into
+        # the statement
+        cursor = DBSession.connection().connection.cursor()
+        try:
+            cursor.copy_expert(
+                b'COPY (%s) TO STDOUT WITH CSV %s' % (
+                    cursor.mogrify(unicode(query), query.params),
+                    cursor.mogrify('DELIMITER %s QUOTE %s', (
+                        self._delimiter_inv[self.delimiter],
+                        self._quotechar_inv[self.quotechar]))),
+                output_file)
+            self.exported = cursor.rowcount
+        finally:
+            cursor.close()
 
     def export(self, output_file):
         """
@@ -126,38 +530,212 @@ class CollectionCsvExporter(object):
 
         `output_file` : a file-like object which the CSV will be written to
         """
-        columns = []
-        aliases = []
+        if self._copy_supported():
+            self._copy(output_file)
+        else:
+            self._writer(output_file).writerows(self._rows())
+
+class CollectionSpooledExporter(CollectionExporter):
+    """
+    Base class for exporters of formats which can only be produced once all
+    rows have been written, such as those with an index at the end of file.
+
+    Descendants must provide a ``_write`` method which writes an iterable of
+    rows to a file-like object.
+    """
+
+    def export(self, output_file):
+        """
+        Export the collection to the specified file.
+
+        `output_file` : a file-like object which the export will be written to
+        """
+        self._write(self._rows(), output_file)
+
+class CollectionXlsExporter(CollectionSpooledExporter):
+    """
+    Excel (BIFF8) exporter class for collections.
+
+    `collection` : the collection to be exported
+
+    Each worksheet starts with a row of column titles. As a BIFF8 worksheet
+    is limited to 65,536 rows, larger collections continue on further
+    worksheets.
+    """
+
+    title = 'Microsoft Excel (.xls)'
+    content_type = 'application/vnd.ms-excel'
+    extension = 'xls'
+    sheet_rows = 65536
+
+    def _write(self, rows, output_file, batch_size=1000):
+        """Writes rows to a workbook saved to output_file"""
+        workbook = xlwt.Workbook(encoding='utf-8')
+        # Styles are constructed once up front; xlwt adds an XF record for
+        # each distinct style it encounters, and creating one per cell is
+        # costly
+        title_style = xlwt.easyxf('font: bold on')
+        default_style = xlwt.Style.default_style
+        styles = {
+            datetime: xlwt.easyxf(num_format_str='yyyy-mm-dd hh:mm:ss'),
+            date:     xlwt.easyxf(num_format_str='yyyy-mm-dd'),
+            }
+        titles = [self.all_columns[column] for column in self.columns]
+        sheet = None
+        for number, row in enumerate(rows):
+            sheetx, rowx = divmod(number, self.sheet_rows - 1)
+            rowx += 1
+            if rowx == 1:
+                sheet = self._add_sheet(
+                    workbook, sheetx + 1, titles, title_style)
+            for colx, value in enumerate(row):
+                if value is not None:
+                    sheet.write(
+                        rowx, colx, value,
+                        styles.get(type(value), default_style))
+            if rowx % batch_size == 0:
+                # Serialize the rows written so far to the worksheet's
+                # temporary file, discarding their cell objects
+                sheet.flush_row_data()
+        if sheet is None:
+            self._add_sheet(workbook, 1, titles, title_style)
+        workbook.save(output_file)
+
+    def _add_sheet(self, workbook, number, titles, style):
+        """Adds the numbered worksheet, headed by titles, to workbook"""
+        sheet = workbook.add_sheet(
+            'Samples' if number == 1 else 'Samples (%d)' % number)
+        for colx, title in enumerate(titles):
+            sheet.write(0, colx, title, style)
+        return sheet
+
+
+class CollectionJsonExporter(CollectionExporter):
+    """
+    JSON Lines exporter class for collections.
+
+    `collection` : the collection to be exported
+
+    Each sample is written as an object on a line of its own, keyed by column
+    identifier. Timestamps are written in ISO 8601 format, and parents and
+    children as lists of sample ids.
+    """
+
+    title = 'JSON Lines'
+    content_type = 'application/x-ndjson'
+    extension = 'jsonl'
+
+    def _formatters(self, query):
+        def format_date(value):
+            if value is not None:
+                return value.isoformat()
+        return [
+            (index, format_date)
+            for (index, column) in enumerate(query.column_descriptions)
+            if isinstance(column['type'], (Date, DateTime))
+            ]
+
+    def _lines(self, rows):
+        """Yields a line of JSON for each of rows"""
+        columns = self.columns
+        for row in self._lineage_lists(rows):
+            yield json.dumps(
+                dict(zip(columns, row)), separators=(',', ':')).encode(
+                    'utf-8') + b'\n'
+
+    def export(self, output_file):
+        """
+        Export the collection to the specified file.
+
+        `output_file` : a file-like object which the lines will be written to
+        """
+        output_file.writelines(self._lines(self._rows()))
+
+class CollectionArrowExporter(CollectionSpooledExporter):
+    """
+    Apache Arrow IPC file exporter class for collections.
+
+    `collection` : the collection to be exported
+
+    Columns are typed: identifiers are 64-bit integers, timestamps are
+    microsecond timestamps, parents and children are lists of identifiers,
+    and everything else (including codes) is a string. Each batch of rows
+    fetched from the database is written as a record batch. Requires pyarrow.
+    """
+
+    title = 'Apache Arrow'
+    content_type = 'application/vnd.apache.arrow.file'
+    extension = 'arrow'
+
+    def _schema(self):
+        """Returns the pyarrow schema of the selected columns"""
+        fields = []
         for column in self.columns:
             if column.startswith('code_'):
-                alias = aliased(SampleCode)
-                aliases.append((alias, column[len('code_'):]))
-                columns.append(getattr(alias, 'value'))
+                arrow_type = pyarrow.string()
             elif column in ('parents', 'children'):
-                raise NotImplementedError
+                arrow_type = pyarrow.list_(pyarrow.int64())
             else:
-                columns.append(Sample.__table__.columns[column])
-        query = DBSession.query(*columns).select_from(Sample).\
-                filter(Sample.collection_id==self.collection.id)
-        for alias, name in aliases:
-            query = query.\
-                outerjoin(alias,
-                    (Sample.id==getattr(alias, 'sample_id')) &
-                    (getattr(alias, 'name')==name)
-                    )
-        writer = csv.writer(output_file,
-            delimiter=self._delimiter_inv[self.delimiter],
-            lineterminator=self._lineterminator_inv[self.lineterminator],
-            quotechar=self._quotechar_inv[self.quotechar],
-            quoting=self._quoting_inv[self.quoting],
-            doublequote=self.doublequote)
-        for row in query:
-            # Rewrite the format of datetime values to exclude microseconds
-            # (which confuse several spreadsheet parsers and which it's
-            # unlikely anyone cares about)
-            row = [
-                value.strftime(self.dateformat)
-                if isinstance(value, datetime) else value
-                for value in row
-                ]
-            writer.writerow(row)
+                sql_type = Sample.__table__.columns[column].type
+                if isinstance(sql_type, DateTime):
+                    arrow_type = pyarrow.timestamp('us')
+                elif isinstance(sql_type, Date):
+                    arrow_type = pyarrow.date32()
+                elif isinstance(sql_type, Integer):
+                    arrow_type = pyarrow.int64()
+                else:
+                    arrow_type = pyarrow.string()
+            fields.append(pyarrow.field(column, arrow_type))
+        return pyarrow.schema(fields)
+
+    def _writer(self, output_file, schema):
+        """Returns a pyarrow writer of schema to output_file"""
+        return pyarrow.ipc.new_file(output_file, schema)
+
+    def _write(self, rows, output_file, batch_size=1000):
+        """Writes rows to output_file in record batches of batch_size"""
+        schema = self._schema()
+        writer = self._writer(output_file, schema)
+        try:
+            rows = self._lineage_lists(rows)
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                writer.write_table(pyarrow.Table.from_arrays([
+                    pyarrow.array(values, type=field.type)
+                    for (values, field) in zip(zip(*batch), schema)
+                    ], schema=schema))
+        finally:
+            writer.close()
+
+
+class CollectionParquetExporter(CollectionArrowExporter):
+    """
+    Apache Parquet exporter class for collections.
+
+    `collection` : the collection to be exported
+
+    Columns are typed as by :class:`CollectionArrowExporter`, with a row group
+    written for each batch of rows fetched from the database. Requires
+    pyarrow.
+    """
+
+    title = 'Apache Parquet'
+    content_type = 'application/vnd.apache.parquet'
+    extension = 'parquet'
+
+    def _writer(self, output_file, schema):
+        return pyarrow.parquet.ParquetWriter(output_file, schema)
+
+
+# The exporter classes for each of the formats accepted by ValidExportFormat
+EXPORTERS = {
+    'csv':   CollectionCsvExporter,
+    'excel': CollectionXlsExporter,
+    'jsonl': CollectionJsonExporter,
+    }
+
+if pyarrow is not None:
+    EXPORTERS['arrow'] = CollectionArrowExporter
+    EXPORTERS['parquet'] = CollectionParquetExporter
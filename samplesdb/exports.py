@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012 Dave Hughes.
+#
+# This file is part of samplesdb.
+#
+# samplesdb is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# samplesdb is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# samplesdb.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Runs collection exports as background jobs.
+
+Submitting an export queues a job on a small pool of threads dedicated to
+exports, so that large collections don't tie up the threads serving requests.
+The job's progress can be polled while it runs, and once complete its output
+can be downloaded from the results directory.
+
+Results are named after a key derived from the collection, its version (which
+changes whenever the collection or its samples do), the format and the
+options, so the results directory doubles as a cache: submitting an export
+whose result exists completes immediately, and submitting one identical to a
+job still queued or running returns that job rather than starting another.
+Results unused for the expiry period are removed, as are the least recently
+used results when the directory exceeds its size limit.
+
+Jobs themselves are tracked in memory, so each process serving the
+application has jobs of its own, but shares the results directory.
+"""
+
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+    division,
+    )
+
+import os
+import io
+import json
+import time
+import errno
+import hashlib
+import logging
+import threading
+from multiprocessing.pool import ThreadPool
+
+import transaction
+
+from samplesdb.exporters import EXPORTERS
+from samplesdb.models import DBSession, Collection, Sample
+
+
+__all__ = ['export_jobs_from_settings', 'ExportJobs', 'ExportJob']
+
+
+class ExportJob(object):
+    """Represents a queued, running or finished export of a collection"""
+
+    def __init__(self, root, key, collection_id, format, options):
+        self.id = os.urandom(16).encode('hex')
+        self.key = key
+        self.collection_id = collection_id
+        self.format = format
+        self.options = options
+        self.status = 'queued'
+        self.total = None
+        self.error = None
+        self.exporter = None
+        self.created = time.time()
+        self.finished = None
+        self.filename = os.path.join(
+            root, '%s.%s' % (key, EXPORTERS[format].extension))
+
+    @property
+    def exported(self):
+        """Returns the number of samples exported so far"""
+        return self.exporter.exported if self.exporter is not None else 0
+
+    @property
+    def progress(self):
+        """Returns the fraction of the export that is complete"""
+        if self.status == 'complete':
+            return 1.0
+        elif not self.total:
+            return 0.0
+        return min(1.0, self.exported / self.total)
+
+    @property
+    def state(self):
+        """Returns a dict describing the job, suitable for JSON rendering"""
+        return dict(
+            id=self.id,
+            status=self.status,
+            exported=self.exported,
+            total=self.total,
+            progress=self.progress,
+            error=self.error,
+            )
+
+    def run(self):
+        """Performs the export, writing the result to filename"""
+        self.status = 'running'
+        temp_filename = '%s.%s.tmp' % (self.filename, self.id)
+        try:
+            with transaction.manager:
+                exporter = EXPORTERS[self.format](
+                    Collection.by_id(self.collection_id))
+                for name, value in self.options.items():
+                    setattr(exporter, name, value)
+                self.total = DBSession.query(Sample).\
+                    filter(Sample.collection_id==self.collection_id).count()
+                self.exporter = exporter
+                with io.open(temp_filename, 'wb') as output_file:
+                    exporter.export(output_file)
+            os.rename(temp_filename, self.filename)
+            self.status = 'complete'
+        except Exception, exc:
+            logging.exception('Export job %s failed', self.id)
+            self.status = 'failed'
+            self.error = str(exc)
+            if os.path.exists(temp_filename):
+                os.unlink(temp_filename)
+        finally:
+            self.finished = time.time()
+            DBSession.remove()
+
+
+class ExportJobs(object):
+    """Queues export jobs, caching their results beneath root"""
+
+    def __init__(
+            self, root, workers=2, expiry=24 * 60 * 60, cache_size=1024**3):
+        if workers < 1:
+            raise ValueError('At least one export worker is required')
+        self.root = root
+        self.expiry = expiry
+        self.cache_size = cache_size
+        self._workers = workers
+        self._pool = None
+        self._jobs = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        """Returns the pool of export threads"""
+        if self._pool is None:
+            self._pool = ThreadPool(self._workers)
+        return self._pool
+
+    def _key(self, collection, format, options):
+        """Returns the key identifying identical exports"""
+        return hashlib.sha1(json.dumps(
+            [collection.id, collection.version, format, options],
+            sort_keys=True)).hexdigest()
+
+    def submit(self, collection, format, options):
+        """
+        Returns the job exporting the specified collection in format, with
+        the exporter attributes in the options dict. The job is complete
+        if the result is cached, and is only queued if an identical job isn't
+        already pending
+        """
+        key = self._key(collection, format, options)
+        with self._lock:
+            self._expire()
+            job = self._pending.get(key)
+            if job is None:
+                if not os.path.exists(self.root):
+                    os.makedirs(self.root)
+                job = ExportJob(self.root, key, collection.id, format, options)
+                self._jobs[job.id] = job
+                if os.path.exists(job.filename):
+                    # Touch the result to mark it recently used
+                    os.utime(job.filename, None)
+                    job.status = 'complete'
+                    job.finished = time.time()
+                else:
+                    self._pending[key] = job
+                    self.pool.apply_async(self._run, (job,))
+            return job
+
+    def _run(self, job):
+        try:
+            job.run()
+        finally:
+            with self._lock:
+                if self._pending.get(job.key) is job:
+                    del self._pending[job.key]
+                self._evict()
+
+    def by_id(self, id):
+        """Returns the job with the specified id, or None if it is unknown"""
+        with self._lock:
+            return self._jobs.get(id)
+
+    def _results(self):
+        """Returns a list of (mtime, size, filename) for cached results"""
+        if not os.path.exists(self.root):
+            return []
+        result = []
+        for name in os.listdir(self.root):
+            filename = os.path.join(self.root, name)
+            try:
+                stat = os.stat(filename)
+            except OSError, exc:
+                # Another process may have removed the file in the meantime
+                if exc.errno != errno.ENOENT:
+                    raise
+            else:
+                result.append((stat.st_mtime, stat.st_size, filename))
+        return result
+
+    def _remove(self, filename):
+        try:
+            os.unlink(filename)
+        except OSError, exc:
+            if exc.errno != errno.ENOENT:
+                raise
+
+    def _expire(self):
+        """
+        Forgets jobs which finished before the expiry period, and removes
+        results (and abandoned partial results) unused within it
+        """
+        threshold = time.time() - self.expiry
+        for job in list(self._jobs.values()):
+            if job.finished is not None and job.finished < threshold:
+                del self._jobs[job.id]
+        for mtime, size, filename in self._results():
+            if mtime < threshold:
+                self._remove(filename)
+
+    def _evict(self):
+        """Removes the least recently used results beyond cache_size"""
+        results = [
+            result for result in self._results()
+            if not result[2].endswith('.tmp')]
+        total = sum(size for (mtime, size, filename) in results)
+        for mtime, size, filename in sorted(results):
+            if total <= self.cache_size:
+                break
+            self._remove(filename)
+            total -= size
+
+    def close(self):
+        """Waits for all queued jobs and shuts down the pool"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+
+def export_jobs_from_settings(settings):
+    """
+    Return an ExportJobs instance using settings supplied from a Paste
+    configuration file
+    """
+    return ExportJobs(
+        root=settings.get(
+            'exports.dir', os.path.join(
+                settings.get('sample_attachments_dir', os.curdir), 'exports')),
+        workers=int(settings.get('exports.workers', 2)),
+        expiry=int(settings.get('exports.expiry', 24 * 60 * 60)),
+        cache_size=int(settings.get('exports.cache_size', 1024**3)))
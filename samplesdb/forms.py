@@ -75,9 +75,14 @@ def css_del_class(attrs, cls):
 
 @subscriber(NewRequest)
 def csrf_validation(event):
-    if event.request.method == 'POST':
+    if event.request.method in ('POST', 'PUT', 'DELETE'):
         logging.debug('Checking CSRF token')
-        token = event.request.POST.get('_csrf')
+        if event.request.method == 'POST':
+            token = event.request.POST.get('_csrf')
+        else:
+            # Requests without a form body (e.g. chunked uploads) must supply
+            # the token in a header instead
+            token = event.request.headers.get('X-CSRF-Token')
         if token is None or token != event.request.session.get_csrf_token():
             logging.debug('CSRF TOKEN IS INVALID!')
             raise HTTPForbidden('CSRF token is missing or invalid')
@@ -24,9 +24,18 @@ from __future__ import (
     division,
     )
 
+import os
+import io
 import re
+import hashlib
+from datetime import datetime
 from unicodedata import normalize
 
+import pytz
+from pyramid.path import AssetResolver
+
+
+CACHE_FOREVER = 365 * 24 * 60 * 60 # 1 year in seconds
 
 _punct_re = re.compile(r'[\t !"#$%&\'()*\-/<=>?@\[\\\]^_`{|},.]+')
 
@@ -40,3 +49,51 @@ def slugify(text, default='', delim='-'):
             result.append(word)
     return delim.join(result) or default
 
+
+_asset_versions = {}
+
+def asset_version(spec):
+    "Returns a short hash of the content of the asset ``spec``"
+    # The hash is cached against the asset's modification time so that, with
+    # template reloading on during development, changes are still picked up
+    filename = AssetResolver().resolve(spec).abspath()
+    mtime = os.stat(filename).st_mtime
+    try:
+        cached_mtime, version = _asset_versions[spec]
+    except KeyError:
+        pass
+    else:
+        if cached_mtime == mtime:
+            return version
+    with io.open(filename, 'rb') as f:
+        version = hashlib.md5(f.read()).hexdigest()[:12]
+    _asset_versions[spec] = (mtime, version)
+    return version
+
+
+def _timezone_choices():
+    "Returns a sorted list of (timezone_id, description) for forms"
+    # Zones are ordered by their offset at a fixed date (east to west, the
+    # order of the instant at which the date begins in each) and then by name
+    now = datetime(2000, 1, 1, 0, 0, 0)
+    offsets = [
+        (pytz.timezone(tz).localize(now), tz)
+        for tz in pytz.common_timezones
+        if tz != 'GMT']
+    return [
+        (tz, '(UTC%s) %s' % (local.strftime('%z'), tz.replace('_', ' ')))
+        for (local, tz) in sorted(offsets)]
+
+TIMEZONE_CHOICES = _timezone_choices()
+
+TIMEZONE_NAMES = frozenset(pytz.all_timezones)
+
+_timezones = {}
+
+def get_timezone(name):
+    "Returns the timezone named ``name``, cached for the life of the process"
+    try:
+        return _timezones[name]
+    except KeyError:
+        tz = _timezones[name] = pytz.timezone(name)
+        return tz
@@ -0,0 +1,307 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012 Dave Hughes.
+#
+# This file is part of samplesdb.
+#
+# samplesdb is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# samplesdb is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# samplesdb.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+    division,
+    )
+
+import io
+import csv
+from datetime import datetime
+from collections import defaultdict
+from itertools import islice
+
+from formencode import Invalid
+from sqlalchemy import select, func
+from zope.sqlalchemy import mark_changed
+
+from samplesdb.exporters import copy_supported
+from samplesdb.validators import (
+    BaseSchema,
+    ValidSampleDescription,
+    ValidSampleLocation,
+    ValidSampleCreated,
+    ValidSampleParents,
+    ValidCodeName,
+    ValidCodeValue,
+    )
+from samplesdb.models import (
+    DBSession,
+    Collection,
+    Sample,
+    SampleCode,
+    SampleLogEntry,
+    SampleOrigin,
+    count_code_names,
+    )
+
+
+class SampleImportSchema(BaseSchema):
+    description = ValidSampleDescription()
+    location = ValidSampleLocation()
+    created = ValidSampleCreated()
+    parents = ValidSampleParents()
+
+
+class CollectionCsvImporter(object):
+    """
+    CSV importer class for collections.
+
+    `collection` : the collection to import samples into
+
+    `creator` : the user the samples are logged as created by
+
+    The first row of the file names the columns, with either the identifiers
+    or the titles used by the exporters. A description column is required;
+    location, created (formatted according to ``dateformat``) and parents (a
+    space separated list of the ids of samples already in the collection) are
+    optional. Any other column is a code, named either by the title or by the
+    "code_" prefixed identifier. Empty code cells are ignored.
+
+    Rows are validated and inserted in batches. Invalid rows are skipped, and
+    after import the ``errors`` property is a list of (line, message) tuples
+    describing them while ``imported`` is the number of samples created.
+
+    On PostgreSQL (with psycopg2) each batch is loaded with COPY rather than
+    INSERT statements, unless ``fast_path`` is False.
+    """
+
+    # Columns of the exporters which cannot be imported
+    ignored_columns = set(('id', 'destroyed', 'children'))
+
+    # Maps the (lower-cased) identifiers and titles of the exporters' sample
+    # columns to their identifiers
+    column_titles = {
+        'id':          'id',
+        'identifier':  'id',
+        'description': 'description',
+        'created':     'created',
+        'destroyed':   'destroyed',
+        'location':    'location',
+        'parents':     'parents',
+        'children':    'children',
+        }
+
+    def __init__(self, collection, creator):
+        self.collection = collection
+        self.creator = creator
+        self.dateformat = '%Y-%m-%d'
+        self.imported = 0
+        self.errors = []
+        self.fast_path = True
+
+    def _columns(self, header):
+        """
+        Returns a list of (index, column) tuples for the sample columns of
+        the header row, and a list of (index, name) tuples for its codes
+        """
+        columns = []
+        codes = []
+        for index, title in enumerate(header):
+            title = title.strip()
+            column = self.column_titles.get(title.lower())
+            if column in self.ignored_columns:
+                continue
+            elif column is not None:
+                columns.append((index, column))
+            else:
+                name = title
+                if name.startswith('code_'):
+                    name = name[len('code_'):]
+                # Code names are validated once for the whole file
+                codes.append((index, ValidCodeName().to_python(name)))
+        if not 'description' in [column for (index, column) in columns]:
+            raise Invalid('A description column is required', header, None)
+        return columns, codes
+
+    def _validate(self, batch, columns, codes):
+        """
+        Returns a list of (sample, codes) dict tuples for the valid rows of
+        batch (a list of (line, row) tuples), recording errors for the others
+        """
+        schema = SampleImportSchema(
+            created=ValidSampleCreated(self.dateformat))
+        code_validator = ValidCodeValue()
+        result = []
+        for line, row in batch:
+            try:
+                row = [cell.decode('utf-8') for cell in row]
+                sample = dict((column, '') for column in schema.fields)
+                sample.update(
+                    (column, row[index]) for (index, column) in columns
+                    if index < len(row))
+                sample = schema.to_python(sample)
+                sample_codes = dict(
+                    (name, code_validator.to_python(row[index]))
+                    for (index, name) in codes
+                    if index < len(row) and row[index].strip())
+            except UnicodeDecodeError:
+                self.errors.append((line, 'Row is not valid UTF-8'))
+            except Invalid, exc:
+                self.errors.append((line, str(exc)))
+            else:
+                result.append((line, sample, sample_codes))
+        # Parents are checked with a single query for the whole batch
+        parent_ids = set(
+            parent_id
+            for (line, sample, sample_codes) in result
+            for parent_id in sample['parents'])
+        if parent_ids:
+            existing = set(
+                sample_id for (sample_id,) in DBSession.query(Sample.id).\
+                    filter(Sample.collection_id==self.collection.id).\
+                    filter(Sample.id.in_(parent_ids)))
+            valid = []
+            for line, sample, sample_codes in result:
+                missing = set(sample['parents']) - existing
+                if missing:
+                    self.errors.append((line, 'Parents %s do not exist' % (
+                        ' '.join(str(i) for i in sorted(missing)))))
+                else:
+                    valid.append((line, sample, sample_codes))
+            result = valid
+        return [
+            (sample, sample_codes)
+            for (line, sample, sample_codes) in result]
+
+    def _allocate_ids(self, count):
+        """
+        Returns count new sample ids, after bumping the version of the
+        collection
+        """
+        # On databases without sequences the update also serializes
+        # concurrent imports (and sample creation), so that the range beyond
+        # the current maximum id is safe to use
+        DBSession.execute(
+            Collection.__table__.update().
+            where(Collection.id==self.collection.id).
+            values(version=Collection.version + 1))
+        bind = DBSession.get_bind()
+        if bind.dialect.name == 'postgresql':
+            return [
+                sample_id for (sample_id,) in DBSession.execute(
+                    select([func.nextval('samples_id_seq')]).
+                    select_from(func.generate_series(1, count)))]
+        start = DBSession.execute(select([func.max(Sample.id)])).scalar() or 0
+        return range(start + 1, start + count + 1)
+
+    def _copy(self, table, records):
+        """Inserts records (dicts with identical keys) into table with COPY"""
+        columns = sorted(records[0])
+        buf = io.BytesIO()
+        # Quoting all strings distinguishes empty strings from NULLs, which
+        # COPY reads from empty unquoted fields
+        writer = csv.writer(buf, quoting=csv.QUOTE_NONNUMERIC)
+        for record in records:
+            writer.writerow([
+                value.encode('utf-8') if isinstance(value, unicode) else value
+                for value in (record[column] for column in columns)])
+        buf.seek(0)
+        cursor = DBSession.connection().connection.cursor()
+        try:
+            cursor.copy_expert(
+                'COPY %s (%s) FROM STDIN WITH CSV' % (
+                    table.name, ', '.join(columns)),
+                buf)
+        finally:
+            cursor.close()
+
+    def _write(self, table, records):
+        """Inserts records (dicts with identical keys) into table"""
+        if records:
+            if self.fast_path and copy_supported():
+                self._copy(table, records)
+            else:
+                DBSession.execute(table.insert(), records)
+
+    def _insert(self, rows):
+        """Inserts the samples, codes, log entries and origins of rows"""
+        now = datetime.utcnow()
+        sample_ids = self._allocate_ids(len(rows))
+        self._write(Sample.__table__, [
+            dict(
+                id=sample_id,
+                collection_id=self.collection.id,
+                description=sample['description'],
+                location=sample['location'],
+                created=sample['created'] or now,
+                notes_markup='text',
+                notes='')
+            for (sample_id, (sample, sample_codes)) in zip(sample_ids, rows)])
+        self._write(SampleLogEntry.__table__, [
+            dict(
+                sample_id=sample_id,
+                created=now,
+                creator_id=self.creator.id,
+                event='create',
+                message='Sample imported')
+            for sample_id in sample_ids])
+        self._write(SampleCode.__table__, [
+            dict(sample_id=sample_id, name=name, value=value)
+            for (sample_id, (sample, sample_codes)) in zip(sample_ids, rows)
+            for (name, value) in sample_codes.items()])
+        # The inserts bypass the events maintaining the collection's code
+        # names, so they're counted here
+        counts = defaultdict(int)
+        for (sample, sample_codes) in rows:
+            for name in sample_codes:
+                counts[(self.collection.id, name)] += 1
+        count_code_names(DBSession.connection(), counts)
+        self._write(SampleOrigin.__table__, [
+            dict(sample_id=sample_id, parent_id=parent_id)
+            for (sample_id, (sample, sample_codes)) in zip(sample_ids, rows)
+            for parent_id in sample['parents']])
+        self.imported += len(rows)
+
+    def import_file(self, input_file, batch_size=1000):
+        """
+        Import samples from the specified file, returning the number of
+        samples imported.
+
+        `input_file` : a file-like object containing UTF-8 encoded CSV
+        """
+        reader = csv.reader(input_file)
+        header = next(reader, None)
+        if not header:
+            self.errors.append((1, 'The file is empty'))
+            return 0
+        try:
+            # Strip the byte-order mark that Excel writes at the start of UTF-8
+            header[0] = header[0].decode('utf-8-sig').encode('utf-8')
+            columns, codes = self._columns(
+                [cell.decode('utf-8') for cell in header])
+        except (Invalid, UnicodeDecodeError), exc:
+            self.errors.append((1, str(exc)))
+            return 0
+        lines = enumerate(reader, start=2)
+        while True:
+            batch = list(islice(lines, batch_size))
+            if not batch:
+                break
+            rows = self._validate(batch, columns, codes)
+            if rows:
+                self._insert(rows)
+        # The inserts bypass the ORM, so the session must be told to commit,
+        # and the collection's loaded state refreshed
+        mark_changed(DBSession())
+        DBSession.expire(self.collection, ['version', 'all_samples'])
+        return self.imported
@@ -37,18 +37,22 @@ import re
 import shutil
 import mimetypes
 import tempfile
-from contextlib import closing
+from itertools import chain
 from datetime import datetime, timedelta
 
 import pytz
 from passlib.context import CryptContext
 from sqlalchemy import (
     Table,
+    select,
     Column,
     ForeignKey,
     ForeignKeyConstraint,
     CheckConstraint,
     func,
+    and_,
+    case,
+    or_,
     event,
     )
 from sqlalchemy.types import (
@@ -63,21 +67,28 @@ from sqlalchemy.types import (
     Float,
     )
 from sqlalchemy.orm import (
+    Session,
     scoped_session,
     sessionmaker,
     relationship,
+    column_property,
     synonym,
     backref,
     )
+from sqlalchemy.orm.attributes import get_history, PASSIVE_NO_INITIALIZE
 from sqlalchemy.orm.collections import attribute_mapped_collection
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.ext.associationproxy import association_proxy
 from sqlalchemy.engine import Engine
 from zope.sqlalchemy import ZopeTransactionExtension
 from pyramid.threadlocal import get_current_registry
+from pyramid.settings import asbool
 
 from samplesdb.image import can_resize, make_thumbnail
+from samplesdb.compress import can_compress, is_compressed, open_compressed
+from samplesdb.blobs import BlobStore
 from samplesdb.licenses import License
+from samplesdb.helpers import get_timezone
 
 
 DBSession = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
@@ -464,6 +475,7 @@ class User(Base):
         creator=lambda k, v: UserCollection(collection=k, role=v))
     # user_groups defined as backref on Group
     groups = association_proxy('user_groups', 'id')
+    # storage_used defined as column_property below UserCollection
 
     def __repr__(self):
         return ('<User: name="%s">' % ' '.join((
@@ -524,7 +536,7 @@ class User(Base):
 
     def _get_timezone(self):
         """Return the timezone object corresponding to the name"""
-        return pytz.timezone(self.timezone_name)
+        return get_timezone(self.timezone_name)
 
     def _set_timezone(self, value):
         """Set the timezone to the name of the timezone object"""
@@ -586,11 +598,9 @@ class User(Base):
             for sample in collection.all_samples]
 
     @property
-    def storage_used(self):
-        # XXX Do this with a query
-        return sum(
-            sample.attachments.storage_used
-            for sample in self.owned_samples)
+    def storage_remaining(self):
+        """Returns the number of bytes the user may still store"""
+        return max(0, self.limits.storage_limit - self.storage_used)
 
 
 class UserLimit(Base):
@@ -709,6 +719,40 @@ class SampleLogEntry(Base):
     created = synonym('_created', descriptor=property(_get_created, _set_created))
 
 
+def sample_path(root, sample_id):
+    """
+    Returns the directory beneath root for the sample with id ``sample_id``.
+
+    Sample directories are bucketed by their id to avoid any single directory
+    growing too large, e.g. sample 1234567 resides in ``root/12/34/1234567``.
+    """
+    return os.path.join(
+        root,
+        '%02d' % (sample_id // 100000 % 100),
+        '%02d' % (sample_id // 1000 % 100),
+        '%d' % sample_id)
+
+
+def generate_thumbnail(source, target, mime_type):
+    """Generates the thumbnail target of the image source"""
+    # Module level so that it can be executed by a process pool
+    if mime_type == 'image/svg+xml':
+        # Just copy the SVG over - we'll resize it when we display it. As with
+        # make_thumbnail, the copy is renamed into place so that requests
+        # never see a partially written thumbnail
+        tempfd, temppath = tempfile.mkstemp(dir=os.path.dirname(target))
+        os.close(tempfd)
+        try:
+            shutil.copyfile(source, temppath)
+        except:
+            os.unlink(temppath)
+            raise
+        os.rename(temppath, target)
+    elif can_resize(mime_type):
+        # Otherwise, resize to a JPEG
+        make_thumbnail(source, target)
+
+
 class SampleAttachments(object):
     """Represents all attachments of a sample"""
     # TODO Add SA instance delete/remove event to destroy attachment directories
@@ -716,15 +760,27 @@ class SampleAttachments(object):
     def __init__(self, sample):
         self.sample = sample
 
-    @property
-    def path(self):
+    def _sample_path(self, kind):
         if self.sample.id is None:
             DBSession.flush()
             assert self.sample.id is not None
-        return os.path.join(
-            get_current_registry().settings['sample_attachments_dir'],
-            'attachments',
-            '%d' % self.sample.id)
+        settings = get_current_registry().settings
+        root = os.path.join(settings['sample_attachments_dir'], kind)
+        result = sample_path(root, self.sample.id)
+        # While migrate_samplesdb_attachments is moving directories from the
+        # old flat layout, fall back to the old location for those not yet
+        # moved
+        if (
+                asbool(settings.get('sample_attachments_migrating', False))
+                and not os.path.exists(result)):
+            legacy = os.path.join(root, '%d' % self.sample.id)
+            if os.path.exists(legacy):
+                result = legacy
+        return result
+
+    @property
+    def path(self):
+        return self._sample_path('attachments')
 
     def __contains__(self, attachment):
         return os.path.exists(self._filename(attachment))
@@ -759,10 +815,26 @@ class SampleAttachments(object):
             strict=False)[0] or 'application/octet-stream'
 
     def content_encoding(self, attachment):
+        """Returns the encoding of the attachment's content on disk"""
+        if self.compressed(attachment):
+            return 'gzip'
         return mimetypes.guess_type(
             self._filename(attachment),
             strict=False)[1]
 
+    def compressed(self, attachment):
+        """Returns True if the attachment was compressed for storage"""
+        s = self._filename(attachment)
+        return os.path.exists(s) and is_compressed(s)
+
+    def _compress(self, attachment):
+        """Returns True if the attachment should be compressed for storage"""
+        return (
+            asbool(get_current_registry().settings.get(
+                'sample_attachments_compress', False))
+            and not mimetypes.guess_type(attachment, strict=False)[1]
+            and can_compress(self.mime_type(attachment)))
+
     def updated(self, attachment):
         s = self._filename(attachment)
         if os.path.exists(s):
@@ -774,63 +846,163 @@ class SampleAttachments(object):
         result = 0
         if os.path.exists(s):
             result += os.stat(s).st_size
-        if os.path.exists(t):
+        if t is not None and os.path.exists(t):
             result += os.stat(t).st_size
         return result
 
+    def filename(self, attachment):
+        """Returns the filename of the attachment's content on disk"""
+        if attachment and os.path.basename(attachment) == attachment:
+            s = self._filename(attachment)
+            # An empty name (or "." etc.) would otherwise find the directory
+            if os.path.isfile(s):
+                return s
+
     def open(self, attachment):
         """Returns the attachment as a file-like object"""
         # Caller is responsible for closing
+        s = self.filename(attachment)
+        if s is not None:
+            if is_compressed(s):
+                return open_compressed(s)
+            return io.open(s, 'rb')
+
+    @property
+    def blobs(self):
+        return BlobStore(os.path.join(
+            get_current_registry().settings['sample_attachments_dir'],
+            'blobs'))
+
+    def _content_size(self, attachment):
         s = self._filename(attachment)
         if os.path.exists(s):
-            return io.open(s, 'rb')
+            return os.stat(s).st_size
+        return 0
+
+    def _account(self, delta):
+        """Adjusts the storage counter of the sample's collection"""
+        if delta:
+            # Updated in SQL so concurrent uploads to the collection don't
+            # overwrite each other's changes. The counter is clamped at zero
+            # as files stored before it was introduced were never counted
+            # (see account_samplesdb_storage)
+            used = Collection.storage_used + delta
+            DBSession.query(Collection).\
+                filter_by(id=self.sample.collection_id).\
+                update(
+                    {Collection.storage_used:
+                        case([(used < 0, 0)], else_=used)},
+                    synchronize_session=False)
+            collection = DBSession.query(Collection).get(
+                self.sample.collection_id)
+            DBSession.expire(collection, ['storage_used'])
 
     def create(self, attachment, file_obj):
         """Creates the attachment's content from a file-like object"""
         s = self._filename(attachment)
+        old_size = self._content_size(attachment)
         if file_obj is None:
             if os.path.exists(s):
                 os.unlink(s)
+            self._remove_thumb(attachment)
+            self._account(-old_size)
         else:
-            path = os.path.dirname(s)
+            # Content is stored once in the blob store; the attachment itself
+            # is merely a hard-link to the blob
             file_obj.seek(0)
-            if not os.path.exists(path):
-                os.makedirs(path)
-            tempfd, temppath = tempfile.mkstemp(dir=path)
-            try:
-                with closing(os.fdopen(tempfd, 'wb')) as f:
-                    while True:
-                        data = file_obj.read(1024**2)
-                        if not data:
-                            break
-                        f.write(data)
-            except:
-                os.unlink(temppath)
-                raise
-            os.rename(temppath, s)
+            blobs = self.blobs
+            name, size = blobs.store(file_obj, self._compress(attachment))
+            blobs.link(name, s)
+            self._remove_thumb(attachment)
+            self._account(size - old_size)
 
     replace = create
 
+    def create_all(self, files, workers=None):
+        """
+        Creates attachments from a sequence of (attachment, file_obj) tuples.
+
+        If a WorkerPools instance is given, content is stored on its threads
+        in parallel and thumbnails are then generated on its processes in the
+        background. The method returns once all content is stored, without
+        waiting for the thumbnails.
+        """
+        files = [
+            (attachment, file_obj, self._compress(attachment))
+            for (attachment, file_obj) in files]
+        blobs = self.blobs
+        def store(f):
+            attachment, file_obj, compress = f
+            file_obj.seek(0)
+            return blobs.store(file_obj, compress)
+        if workers is None:
+            results = [store(f) for f in files]
+        else:
+            results = workers.threads.map(store, files)
+        # Link in the order given, so that a repeated name ends up with its
+        # last content just as if create() had been called for each file
+        delta = 0
+        for (attachment, file_obj, compress), (name, size) in zip(files, results):
+            delta += size - self._content_size(attachment)
+            blobs.link(name, self._filename(attachment))
+            self._remove_thumb(attachment)
+        self._account(delta)
+        if workers is not None and workers.processes is not None:
+            for attachment in sorted(set(f[0] for f in files)):
+                self._queue_thumbnail(attachment, workers.processes)
+
+    def _queue_thumbnail(self, attachment, pool):
+        """Generates the attachment's thumbnail on a process pool"""
+        t = self._thumb_filename(attachment)
+        if t is not None:
+            path = os.path.dirname(t)
+            if not os.path.exists(path):
+                os.makedirs(path)
+            pool.apply_async(generate_thumbnail, (
+                self._filename(attachment), t, self.mime_type(attachment)))
+
+    def ingest(self, attachment, filename):
+        """Creates the attachment's content by moving the file filename"""
+        # As create() but, provided filename lies on the same file-system, the
+        # content is renamed into place rather than copied
+        old_size = self._content_size(attachment)
+        blobs = self.blobs
+        name, size = blobs.store_file(filename, self._compress(attachment))
+        blobs.link(name, self._filename(attachment))
+        self._remove_thumb(attachment)
+        self._account(size - old_size)
+
+    def copy(self, attachment, target):
+        """Copies the attachment to the SampleAttachments instance target"""
+        # As attachments are hard-links to blobs, this is simply another link
+        old_size = target._content_size(attachment)
+        BlobStore.link_file(
+            self._filename(attachment), target._filename(attachment))
+        target._remove_thumb(attachment)
+        target._account(self._content_size(attachment) - old_size)
+
     def remove(self, attachment):
         """Removes the attachment"""
         if self.sample.default_attachment == attachment:
             self.sample.default_attachment = None
         s = self._filename(attachment)
-        t = self._thumb_filename(attachment)
         if os.path.exists(s):
+            self._account(-os.stat(s).st_size)
             os.unlink(s)
-        if os.path.exists(t):
-            os.unlink(t)
+        self._remove_thumb(attachment)
 
     @property
     def thumb_path(self):
-        if self.sample.id is None:
-            DBSession.flush()
-            assert self.sample.id is not None
-        return os.path.join(
-            get_current_registry().settings['sample_attachments_dir'],
-            'thumbs',
-            '%d' % self.sample.id)
+        return self._sample_path('thumbs')
+
+    def _remove_thumb(self, attachment):
+        """Removes the attachment's thumbnail, if any"""
+        # Content linked from an existing blob keeps the blob's modification
+        # time, which may predate the current thumbnail, so thumb_filename
+        # can't be relied upon to notice it is stale
+        t = self._thumb_filename(attachment)
+        if t is not None and os.path.exists(t):
+            os.unlink(t)
 
     def _thumb_filename(self, attachment):
         root = os.path.join(self.thumb_path, os.path.basename(attachment))
@@ -859,8 +1031,8 @@ class SampleAttachments(object):
         if s is not None and os.path.exists(s):
             return os.stat(s).st_size
 
-    def thumb_open(self, attachment):
-        """Returns the attachment's thumbnail image as a file-like object"""
+    def thumb_filename(self, attachment):
+        """Returns the filename of the attachment's thumbnail image on disk"""
         s = self._filename(attachment)
         t = self._thumb_filename(attachment)
         # Regenerate the thumbnail if it's stale
@@ -870,19 +1042,20 @@ class SampleAttachments(object):
                 path = os.path.dirname(t)
                 if not os.path.exists(path):
                     os.makedirs(path)
-                mime_type = self.mime_type(attachment)
-                if mime_type == 'image/svg+xml':
-                    # Just copy the SVG over - we'll resize it when we display it
-                    shutil.copyfile(s, t)
-                elif can_resize(mime_type):
-                    # Otherwise, resize to a JPEG
-                    make_thumbnail(s, t)
+                generate_thumbnail(s, t, self.mime_type(attachment))
             if os.path.exists(t):
-                return io.open(t, 'rb')
+                return t
         else:
             # XXX Return some generic thumbnail?
             return None
 
+    def thumb_open(self, attachment):
+        """Returns the attachment's thumbnail image as a file-like object"""
+        # Caller is responsible for closing
+        t = self.thumb_filename(attachment)
+        if t is not None:
+            return io.open(t, 'rb')
+
 
 class Sample(Base):
     __tablename__ = 'samples'
@@ -1007,7 +1180,8 @@ class Sample(Base):
             sample.parents.append(aliquot)
         return sample
 
-    def split(self, creator, collection, aliquots, aliquant=False, **kwargs):
+    def split(self, creator, collection, aliquots, aliquant=False,
+            copy_attachments=False, **kwargs):
         """Split this sample into several aliquots"""
         if aliquots < 1:
             raise ValueError('Cannot split a sample into less than 1 aliquot')
@@ -1036,6 +1210,12 @@ class Sample(Base):
             aliquant = Sample.create(creator, collection, **aliargs)
             aliquant.parents.append(self)
             aliquots.append(aliquant)
+        if copy_attachments:
+            for aliquot in aliquots:
+                DBSession.add(aliquot)
+                for attachment in self.attachments:
+                    self.attachments.copy(attachment, aliquot.attachments)
+                aliquot.default_attachment = self.default_attachment
         self.destroy(creator, reason)
         return aliquots
 
@@ -1086,6 +1266,13 @@ class Collection(Base):
         'collection_users', 'role',
         creator=lambda k, v: UserCollection(user=k, role=v))
     owner = Column(Unicode(200), nullable=False)
+    # Maintained by SampleAttachments as content is added and removed
+    storage_used = Column(
+        BigInteger, CheckConstraint('storage_used >= 0'),
+        default=0, nullable=False)
+    # Incremented by bump_collection_versions whenever the collection or its
+    # samples change
+    version = Column(Integer, default=0, nullable=False)
     _license = Column(
         'license', Unicode(30), default='notspecified', nullable=False)
     all_samples = relationship(Sample, backref='collection')
@@ -1131,6 +1318,14 @@ class Collection(Base):
 
     license = synonym('_license', descriptor=property(_get_license, _set_license))
 
+    @property
+    def code_names(self):
+        """return the sorted names of the codes used in the collection"""
+        return [
+            name for (name,) in DBSession.query(CollectionCodeName.name).\
+                filter(CollectionCodeName.collection_id==self.id).\
+                order_by(CollectionCodeName.name)]
+
     @property
     def existing_samples(self):
         # XXX Do this with a query
@@ -1214,6 +1409,17 @@ class UserCollection(Base):
     role = relationship(Role)
 
 
+# A user's storage is the sum of the counters of the collections they can edit.
+# As collections are limited per user this is loaded along with the user in a
+# single query, keeping quota checks cheap
+User.storage_used = column_property(
+    select([func.coalesce(func.sum(Collection.storage_used), 0)]).\
+        where(Collection.id == UserCollection.collection_id).\
+        where(UserCollection.user_id == User.id).\
+        where(UserCollection.role_id.in_(('editor', 'owner'))).\
+        correlate_except(Collection, UserCollection))
+
+
 class UserGroup(Base):
     __tablename__ = 'user_groups'
 
@@ -1238,3 +1444,170 @@ class SampleOrigin(Base):
         Integer, ForeignKey(
             'samples.id', onupdate='RESTRICT', ondelete='CASCADE'),
         primary_key=True)
+
+
+class CollectionCodeName(Base):
+    __tablename__ = 'collection_code_names'
+
+    collection_id = Column(
+        Integer, ForeignKey(
+            'collections.id', onupdate='RESTRICT', ondelete='CASCADE'),
+        primary_key=True)
+    name = Column(Unicode(20), primary_key=True)
+    # Maintained by count_code_names as codes are added and removed
+    samples = Column(Integer, default=0, nullable=False)
+
+
+def count_code_names(connection, counts):
+    """
+    Adjusts the sample counts of the collection_code_names table by counts,
+    a dict mapping (collection_id, name) tuples to the change in the number
+    of samples with that code. Names no longer used by any sample of a
+    collection are removed
+    """
+    table = CollectionCodeName.__table__
+    for (collection_id, name), delta in counts.items():
+        condition = and_(
+            table.c.collection_id==collection_id, table.c.name==name)
+        if delta > 0:
+            result = connection.execute(
+                table.update().where(condition).
+                values(samples=table.c.samples + delta))
+            if result.rowcount == 0:
+                connection.execute(table.insert().values(
+                    collection_id=collection_id, name=name, samples=delta))
+        elif delta < 0:
+            connection.execute(
+                table.update().where(condition).
+                values(samples=table.c.samples + delta))
+            connection.execute(
+                table.delete().where(condition).where(table.c.samples <= 0))
+
+def _code_collection_id(connection, sample_id):
+    return connection.execute(
+        select([Sample.__table__.c.collection_id]).
+        where(Sample.__table__.c.id==sample_id)).scalar()
+
+def code_inserted(mapper, connection, target):
+    count_code_names(connection, {
+        (_code_collection_id(connection, target.sample_id), target.name): 1})
+
+def code_updated(mapper, connection, target):
+    history = get_history(target, 'name')
+    if history.deleted:
+        collection_id = _code_collection_id(connection, target.sample_id)
+        count_code_names(connection, {
+            (collection_id, history.deleted[0]): -1,
+            (collection_id, target.name): 1,
+            })
+
+def code_deleted(mapper, connection, target):
+    count_code_names(connection, {
+        (_code_collection_id(connection, target.sample_id), target.name): -1})
+
+def sample_deleted(mapper, connection, target):
+    # Codes which the session has loaded are deleted (firing code_deleted)
+    # before their sample; the database cascades the deletion of the rest,
+    # which must be counted here
+    codes = SampleCode.__table__
+    count_code_names(connection, dict(
+        ((target.collection_id, name), -1)
+        for (name,) in connection.execute(
+            select([codes.c.name]).where(codes.c.sample_id==target.id))))
+
+def sample_updated(mapper, connection, target):
+    # Moving a sample to another collection moves its codes with it
+    history = get_history(target, 'collection_id')
+    if history.deleted and history.deleted[0] is not None:
+        codes = SampleCode.__table__
+        counts = {}
+        for (name,) in connection.execute(
+                select([codes.c.name]).where(codes.c.sample_id==target.id)):
+            counts[(history.deleted[0], name)] = -1
+            counts[(target.collection_id, name)] = 1
+        count_code_names(connection, counts)
+
+def sample_moved(mapper, connection, target):
+    # Moving a sample to another collection moves its attachments' storage
+    # with it
+    history = get_history(target, 'collection_id')
+    if history.deleted and history.deleted[0] is not None:
+        attachments = target.attachments
+        size = sum(attachments._content_size(a) for a in attachments)
+        if size:
+            table = Collection.__table__
+            session = Session.object_session(target)
+            for collection_id, delta in (
+                    (history.deleted[0], -size),
+                    (target.collection_id, size)):
+                used = table.c.storage_used + delta
+                connection.execute(
+                    table.update().
+                    where(table.c.id==collection_id).
+                    values(storage_used=case([(used < 0, 0)], else_=used)))
+                collection = session.identity_map.get(
+                    Collection.__mapper__.identity_key_from_primary_key(
+                        [collection_id]))
+                if collection is not None:
+                    session.expire(collection, ['storage_used'])
+
+event.listen(SampleCode, 'after_insert', code_inserted)
+event.listen(SampleCode, 'after_update', code_updated)
+event.listen(SampleCode, 'after_delete', code_deleted)
+event.listen(Sample, 'after_update', sample_updated)
+event.listen(Sample, 'after_update', sample_moved)
+event.listen(Sample, 'before_delete', sample_deleted)
+
+
+def bump_collection_versions(session, flush_context, instances):
+    """
+    Increments the version of every collection with changes pending in the
+    flush, so that anything derived from a collection's content (such as its
+    exports) can tell when it is out of date
+    """
+    collection_ids = set()
+    sample_ids = set()
+    def sample_changed(sample):
+        if sample.collection_id is not None:
+            collection_ids.add(sample.collection_id)
+        elif sample.collection is not None:
+            collection_ids.add(sample.collection.id)
+    for obj in session.new | session.dirty | session.deleted:
+        if isinstance(obj, Collection):
+            collection_ids.add(obj.id)
+        elif isinstance(obj, Sample):
+            sample_changed(obj)
+            # Lineage changes alter the other sample's parents or children
+            for name in ('parents', 'children'):
+                history = get_history(obj, name, PASSIVE_NO_INITIALIZE)
+                for other in chain(history.added or (), history.deleted or ()):
+                    sample_changed(other)
+        elif isinstance(obj, SampleCode):
+            if obj.sample_id is not None:
+                sample_ids.add(obj.sample_id)
+            elif obj.sample is not None:
+                sample_changed(obj.sample)
+        elif isinstance(obj, SampleOrigin):
+            sample_ids.add(obj.sample_id)
+            sample_ids.add(obj.parent_id)
+    collection_ids.discard(None)
+    sample_ids.discard(None)
+    if collection_ids or sample_ids:
+        # The counter is incremented in SQL (a query would autoflush here)
+        # and the stale attribute expired from any loaded collections
+        conditions = []
+        if collection_ids:
+            conditions.append(Collection.id.in_(collection_ids))
+        if sample_ids:
+            conditions.append(Collection.id.in_(
+                select([Sample.collection_id]).
+                where(Sample.id.in_(sample_ids))))
+        session.execute(
+            Collection.__table__.update().
+            where(or_(*conditions)).
+            values(version=Collection.version + 1))
+        for obj in session.identity_map.values():
+            if isinstance(obj, Collection) and not obj in session.deleted:
+                session.expire(obj, ['version'])
+
+event.listen(Session, 'before_flush', bump_collection_versions)
@@ -0,0 +1,94 @@
+"""
+Recounts the storage used by each collection from the attachments on disk.
+
+Collections only count the content of attachments stored since their storage
+counter was introduced; run this once against existing instances to include
+older attachments, and again whenever the counters are suspected to have
+drifted. Uploads completing while it runs may be miscounted, so it is best
+run while the application is stopped.
+"""
+
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+    division,
+    )
+
+import os
+import sys
+import optparse
+from multiprocessing.pool import ThreadPool
+
+import transaction
+from sqlalchemy import engine_from_config
+from pyramid.paster import get_appsettings, setup_logging
+
+from samplesdb.models import DBSession, Collection, Sample, sample_path
+
+
+def content_size(attachments_root, sample_id):
+    """Returns the size of the attachment content of sample_id"""
+    # Directories part-way through migrate_samplesdb_attachments may have
+    # files in either layout
+    result = 0
+    for path in (
+            sample_path(attachments_root, sample_id),
+            os.path.join(attachments_root, '%d' % sample_id)):
+        if os.path.isdir(path):
+            for filename in os.listdir(path):
+                result += os.stat(os.path.join(path, filename)).st_size
+    return result
+
+def account(sample_attachments_dir, jobs=4, dry_run=False):
+    """
+    Sets (or with dry_run, calculates) the storage used by all collections,
+    returning a dict mapping collection ids to bytes used
+    """
+    attachments_root = os.path.join(sample_attachments_dir, 'attachments')
+    result = dict(
+        (collection_id, 0)
+        for (collection_id,) in DBSession.query(Collection.id))
+    def size(sample):
+        sample_id, collection_id = sample
+        return collection_id, content_size(attachments_root, sample_id)
+    pool = ThreadPool(jobs)
+    try:
+        samples = DBSession.query(Sample.id, Sample.collection_id).all()
+        for collection_id, used in pool.imap_unordered(
+                size, samples, chunksize=100):
+            result[collection_id] += used
+    finally:
+        pool.close()
+        pool.join()
+    if not dry_run:
+        for collection_id, used in result.items():
+            DBSession.query(Collection).\
+                filter_by(id=collection_id).\
+                update(
+                    {Collection.storage_used: used},
+                    synchronize_session=False)
+    return result
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] config_uri', description=__doc__.strip(),
+        prog=os.path.basename(argv[0]))
+    parser.add_option('-j', '--jobs', type='int', default=4,
+        help='the number of directories to scan in parallel (default: 4)')
+    parser.add_option('-n', '--dry-run', action='store_true', default=False,
+        help='report the storage used without updating the collections')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error('a configuration file is required')
+    config_uri = args[0]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    with transaction.manager:
+        result = account(
+            settings['sample_attachments_dir'], jobs=options.jobs,
+            dry_run=options.dry_run)
+        for collection_id in sorted(result):
+            print('%-10d %14d bytes' % (collection_id, result[collection_id]))
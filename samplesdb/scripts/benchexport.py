@@ -0,0 +1,174 @@
+"""
+Measures the throughput of collection exports.
+
+A collection of each requested size is generated (with a number of sample
+codes per sample) in a scratch database, which is then exported in the
+requested format, discarding the output. The peak memory usage of the process
+is reported after each export. By default an in-memory SQLite database is
+used; specify a SQLAlchemy URL to benchmark another database, but note that
+its tables will be created and dropped.
+
+Where the database provides a fast path for the format (COPY on PostgreSQL
+for CSV) each export is measured both with and without it. With --import, the
+import of each size's new samples from CSV is measured in the same way.
+"""
+
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+    division,
+    )
+
+import io
+import os
+import sys
+import time
+import tempfile
+import optparse
+import resource
+from datetime import datetime
+
+import transaction
+from sqlalchemy import create_engine
+from zope.sqlalchemy import mark_changed
+
+from samplesdb.scripts.initializedb import init_instances
+from samplesdb.exporters import EXPORTERS, copy_supported
+from samplesdb.importers import CollectionCsvImporter
+from samplesdb.models import (
+    DBSession,
+    Base,
+    Collection,
+    Sample,
+    SampleCode,
+    User,
+    count_code_names,
+    )
+
+
+def populate(collection_id, count, codes=2, batch_size=10000):
+    """Adds count samples, each with the given number of codes"""
+    sample_table = Sample.__table__
+    code_table = SampleCode.__table__
+    now = datetime.utcnow()
+    start = DBSession.query(Sample.id).order_by(Sample.id.desc()).first()
+    start = start[0] + 1 if start else 1
+    with transaction.manager:
+        for offset in range(0, count, batch_size):
+            ids = range(
+                start + offset, start + min(count, offset + batch_size))
+            DBSession.execute(sample_table.insert(), [
+                dict(
+                    id=sample_id, description='Sample %d' % sample_id,
+                    created=now, location='Freezer', notes_markup='text',
+                    notes='', collection_id=collection_id)
+                for sample_id in ids])
+            DBSession.execute(code_table.insert(), [
+                dict(sample_id=sample_id, name=name, value='%s%d' % (
+                    name, sample_id))
+                for sample_id in ids
+                for name in ('code%d' % code for code in range(codes))])
+            count_code_names(DBSession.connection(), dict(
+                ((collection_id, 'code%d' % code), len(ids))
+                for code in range(codes)))
+        mark_changed(DBSession())
+
+def benchmark(collection_id, batch_size=1000, format='csv', fast_path=True):
+    """Returns the number of bytes exported and the time taken"""
+    exporter = EXPORTERS[format](Collection.by_id(collection_id))
+    exporter.fast_path = fast_path
+    start = time.time()
+    with transaction.manager:
+        with tempfile.TemporaryFile() as output_file:
+            exporter.export(output_file)
+            size = output_file.tell()
+    return size, time.time() - start
+
+def benchmark_import(collection_id, count, codes=2, fast_path=True):
+    """
+    Returns the time taken to import count samples, each with the given
+    number of codes. The import is rolled back afterward
+    """
+    input_file = io.BytesIO()
+    input_file.write(b'description,location,%s\n' % b','.join(
+        b'code%d' % code for code in range(codes)))
+    for index in range(count):
+        input_file.write(b'Sample %d,Freezer,%s\n' % (index, b','.join(
+            b'code%d%d' % (code, index) for code in range(codes))))
+    input_file.seek(0)
+    start = time.time()
+    with transaction.manager:
+        importer = CollectionCsvImporter(
+            Collection.by_id(collection_id), DBSession.query(User).first())
+        importer.fast_path = fast_path
+        importer.import_file(input_file)
+        transaction.abort()
+    return time.time() - start
+
+def peak_memory():
+    """Returns the peak resident set size of the process in bytes"""
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, Mac OS X reports bytes
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] [sizes...]', description=__doc__.strip(),
+        prog=os.path.basename(argv[0]))
+    parser.add_option('-u', '--url', default='sqlite://',
+        help='the SQLAlchemy URL of a scratch database (default: %default)')
+    parser.add_option('-b', '--batch-size', type='int', default=1000,
+        help='the number of rows to fetch at once (default: %default)')
+    parser.add_option('-f', '--format', type='choice',
+        choices=sorted(EXPORTERS), default='csv',
+        help='the format to export (default: %default)')
+    parser.add_option('-c', '--codes', type='int', default=2,
+        help='the number of codes each sample has (default: %default)')
+    parser.add_option('-i', '--import', dest='imports', action='store_true',
+        default=False, help='measure the import of each size\'s samples too')
+    options, args = parser.parse_args(argv[1:])
+    try:
+        sizes = [int(size) for size in args] or [10000, 100000, 1000000]
+    except ValueError:
+        parser.error('sizes must be integers')
+    engine = create_engine(options.url)
+    DBSession.configure(bind=engine)
+    Base.metadata.create_all(engine)
+    try:
+        init_instances()
+        collection_id = DBSession.query(Collection.id).first()[0]
+        paths = [('generic', False)]
+        if copy_supported():
+            paths.append(('copy', True))
+        populated = 0
+        for size in sorted(sizes):
+            if options.imports:
+                for path, fast_path in paths:
+                    elapsed = benchmark_import(
+                        collection_id, size - populated, options.codes,
+                        fast_path)
+                    print(
+                        '%8d samples: %-7s import in %7.2fs (%8d rows/s)' % (
+                            size - populated, path, elapsed,
+                            (size - populated) / elapsed))
+            populate(collection_id, size - populated, options.codes)
+            populated = size
+            for path, fast_path in paths:
+                if path != 'generic' and options.format != 'csv':
+                    continue
+                exported, elapsed = benchmark(
+                    collection_id, options.batch_size, options.format,
+                    fast_path)
+                print(
+                    '%8d samples: %-7s %10d bytes in %7.2fs (%8d rows/s), '
+                    'peak memory %6.1fMB' % (
+                        size, path, exported, elapsed, size / elapsed,
+                        peak_memory() / 1024**2))
+    finally:
+        DBSession.remove()
+        Base.metadata.drop_all(engine)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+"""
+Removes attachment and thumbnail directories belonging to samples which no
+longer exist in the database, thumbnails whose original attachment has been
+removed, abandoned uploads, and attachment content no longer referenced by any
+sample.
+
+Anything modified within the grace period is left alone, to avoid racing with
+requests that are still in progress. Content freed by removing directories
+becomes unreferenced and is collected by the following run.
+"""
+
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+    division,
+    )
+
+import os
+import sys
+import time
+import shutil
+import optparse
+from multiprocessing.pool import ThreadPool
+
+from sqlalchemy import engine_from_config
+from pyramid.paster import get_appsettings, setup_logging
+
+from samplesdb.models import DBSession, Sample, sample_path
+from samplesdb.blobs import BlobStore
+from samplesdb.uploads import ChunkedUpload
+
+
+def scan_bucket(root, name):
+    """Yields (sample_id, path) for the sample directories in root/name"""
+    path = os.path.join(root, name)
+    if len(name) != 2:
+        # A sample directory in the old flat layout
+        yield int(name), path
+    else:
+        for sub_name in os.listdir(path):
+            sub_path = os.path.join(path, sub_name)
+            if os.path.isdir(sub_path):
+                for sample_name in os.listdir(sub_path):
+                    if sample_name.isdigit():
+                        sample_id = int(sample_name)
+                        sample_dir = os.path.join(sub_path, sample_name)
+                        if sample_dir == sample_path(root, sample_id):
+                            yield sample_id, sample_dir
+
+def sample_dirs(root, pool):
+    """Yields (sample_id, path) for all sample directories beneath root"""
+    if os.path.exists(root):
+        names = [name for name in os.listdir(root) if name.isdigit()]
+        for dirs in pool.imap_unordered(
+                lambda name: list(scan_bucket(root, name)), names):
+            for sample_dir in dirs:
+                yield sample_dir
+
+def existing_samples(sample_ids, batch_size=1000):
+    """Returns the subset of sample_ids that exist in the database"""
+    sample_ids = sorted(sample_ids)
+    result = set()
+    for i in range(0, len(sample_ids), batch_size):
+        result.update(
+            sample_id for (sample_id,) in DBSession.query(Sample.id).\
+                filter(Sample.id.in_(sample_ids[i:i + batch_size])))
+    return result
+
+def reclaimable(path):
+    """Returns the bytes that removing the file path frees"""
+    stat = os.stat(path)
+    # Attachments are hard-links to blobs; removing the last link (other than
+    # the blob itself) frees the content when the blobs are next collected
+    return stat.st_size if stat.st_nlink <= 2 else 0
+
+def dir_size(path):
+    """Returns the bytes that removing the directory path frees"""
+    return sum(
+        reclaimable(os.path.join(dirpath, filename))
+        for dirpath, dirnames, filenames in os.walk(path)
+        for filename in filenames)
+
+def stale_thumbs(attachments_paths, thumbs_path):
+    """
+    Yields the thumbnails in thumbs_path lacking an original attachment in any
+    of attachments_paths
+    """
+    if os.path.exists(thumbs_path):
+        for filename in os.listdir(thumbs_path):
+            attachment = os.path.splitext(filename)[0]
+            if not any(
+                    os.path.exists(os.path.join(path, attachment))
+                    for path in attachments_paths):
+                yield os.path.join(thumbs_path, filename)
+
+def collect(
+        sample_attachments_dir, grace=24 * 60 * 60, jobs=4, batch_size=1000,
+        dry_run=False):
+    """
+    Removes (or with dry_run, finds) all garbage, returning a dict mapping
+    each kind of garbage to the number of bytes reclaimable
+    """
+    threshold = time.time() - grace
+    def expired(path):
+        return os.stat(path).st_mtime < threshold
+    def remove(path):
+        if not dry_run:
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            else:
+                os.unlink(path)
+    attachments_root = os.path.join(sample_attachments_dir, 'attachments')
+    thumbs_root = os.path.join(sample_attachments_dir, 'thumbs')
+    result = {}
+    pool = ThreadPool(jobs)
+    try:
+        # Orphaned sample directories
+        found = dict(
+            (kind, dict(sample_dirs(root, pool)))
+            for (kind, root) in (
+                ('attachments', attachments_root),
+                ('thumbs', thumbs_root),
+                )
+            )
+        existing = existing_samples(
+            set(found['attachments']) | set(found['thumbs']), batch_size)
+        for kind, dirs in found.items():
+            orphans = [
+                path for (sample_id, path) in dirs.items()
+                if sample_id not in existing and expired(path)]
+            result[kind] = sum(pool.imap_unordered(dir_size, orphans))
+            for _ in pool.imap_unordered(remove, orphans):
+                pass
+        # Thumbnails of removed attachments
+        def find_stale(sample_id):
+            # While migrate_samplesdb_attachments runs, a sample's originals
+            # may be in either layout, regardless of its thumbnails' layout
+            return list(stale_thumbs(
+                (
+                    sample_path(attachments_root, sample_id),
+                    os.path.join(attachments_root, '%d' % sample_id),
+                    ),
+                found['thumbs'][sample_id]))
+        stale = [
+            thumb
+            for thumbs in pool.imap_unordered(
+                find_stale, [
+                    sample_id for sample_id in found['thumbs']
+                    if sample_id in existing])
+            for thumb in thumbs
+            if expired(thumb)]
+        result['stale thumbs'] = sum(os.stat(thumb).st_size for thumb in stale)
+        for _ in pool.imap_unordered(remove, stale):
+            pass
+    finally:
+        pool.close()
+        pool.join()
+    # Abandoned uploads
+    result['uploads'] = 0
+    for upload in ChunkedUpload.all(
+            os.path.join(sample_attachments_dir, 'uploads')):
+        if expired(upload.staging_filename):
+            result['uploads'] += upload.offset
+            if not dry_run:
+                upload.abort()
+    # Unreferenced content
+    blobs = BlobStore(os.path.join(sample_attachments_dir, 'blobs'))
+    result['blobs'] = blobs.collect(grace, dry_run)
+    return result
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] config_uri', description=__doc__.strip(),
+        prog=os.path.basename(argv[0]))
+    parser.add_option('-j', '--jobs', type='int', default=4,
+        help='the number of directories to scan in parallel (default: 4)')
+    parser.add_option('-b', '--batch-size', type='int', default=1000,
+        help='the number of samples to query at once (default: 1000)')
+    parser.add_option('-g', '--grace', type='int', default=24,
+        help='ignore anything modified within this many hours (default: 24)')
+    parser.add_option('-n', '--dry-run', action='store_true', default=False,
+        help='report the space reclaimable without removing anything')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error('a configuration file is required')
+    config_uri = args[0]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    result = collect(
+        settings['sample_attachments_dir'], grace=options.grace * 60 * 60,
+        jobs=options.jobs, batch_size=options.batch_size,
+        dry_run=options.dry_run)
+    for kind in sorted(result):
+        print('%-14s %12d bytes' % (kind, result[kind]))
+    print('%-14s %12d bytes %s' % (
+        'total', sum(result.values()),
+        'reclaimable' if options.dry_run else 'reclaimed'))
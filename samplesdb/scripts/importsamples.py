@@ -0,0 +1,72 @@
+"""
+Imports samples into a collection from a CSV file.
+
+The first row of the file names the columns: a description column is
+required, and location, created and parents columns are optional. Any other
+column is taken to be a sample code. Rows which fail validation are reported
+and skipped; the remainder are imported.
+"""
+
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+    division,
+    )
+
+import os
+import io
+import sys
+import optparse
+
+import transaction
+from sqlalchemy import engine_from_config
+from pyramid.paster import get_appsettings, setup_logging
+
+from samplesdb.importers import CollectionCsvImporter
+from samplesdb.models import DBSession, Collection, User
+
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] config_uri collection_id email filename',
+        description=__doc__.strip(), prog=os.path.basename(argv[0]))
+    parser.add_option('-d', '--date-format', default='%Y-%m-%d',
+        help='the format of the created column (default: %default)')
+    parser.add_option('-b', '--batch-size', type='int', default=1000,
+        help='the number of rows to insert at once (default: 1000)')
+    parser.add_option('-n', '--dry-run', action='store_true', default=False,
+        help='validate the file, but do not keep the imported samples')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 4:
+        parser.error('expected config_uri, collection_id, email and filename')
+    config_uri, collection_id, email, filename = args
+    try:
+        collection_id = int(collection_id)
+    except ValueError:
+        parser.error('collection_id must be an integer')
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    with transaction.manager:
+        collection = Collection.by_id(collection_id)
+        if collection is None:
+            parser.error('collection %d does not exist' % collection_id)
+        user = User.by_email(email)
+        if user is None:
+            parser.error('user %s does not exist' % email)
+        if collection.users.get(user) is None or (
+                collection.users[user].id not in ('owner', 'editor')):
+            parser.error('%s cannot edit collection %d' % (
+                email, collection_id))
+        importer = CollectionCsvImporter(collection, user)
+        importer.dateformat = options.date_format
+        with io.open(filename, 'rb') as input_file:
+            importer.import_file(input_file, batch_size=options.batch_size)
+        for line, message in importer.errors:
+            print('%s:%d: %s' % (filename, line, message), file=sys.stderr)
+        print('Imported %d samples, skipped %d rows' % (
+            importer.imported, len(importer.errors)))
+        if options.dry_run:
+            transaction.abort()
@@ -0,0 +1,94 @@
+"""
+Moves sample attachment and thumbnail directories from the original flat
+layout (attachments/<id>) to the bucketed layout (attachments/<aa>/<bb>/<id>).
+
+The migration may be run while the application is serving requests provided
+sample_attachments_migrating is set to true in the application's configuration
+for the duration. It is safe to run repeatedly; any directories created in the
+old layout while it was running are moved by the next run.
+"""
+
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+    division,
+    )
+
+import os
+import sys
+import optparse
+from multiprocessing.pool import ThreadPool
+
+from pyramid.paster import get_appsettings, setup_logging
+
+from samplesdb.models import sample_path
+
+
+def legacy_dirs(root):
+    """Yields the names of directories in root which may use the old layout"""
+    if os.path.exists(root):
+        for name in os.listdir(root):
+            # Old directories are named by the sample id without padding, so
+            # "00" to "09" can only be buckets. "10" to "99" may be either
+            if name.isdigit() and not (len(name) == 2 and name[0] == '0'):
+                yield name
+
+def migrate_dir(root, name):
+    """Moves the old-layout directory name in root, returning files moved"""
+    source = os.path.join(root, name)
+    target = sample_path(root, int(name))
+    if len(name) != 2 and not os.path.exists(target):
+        # The whole directory can be moved in a single (atomic) operation
+        path = os.path.dirname(target)
+        if not os.path.exists(path):
+            os.makedirs(path)
+        count = len(os.listdir(source))
+        os.rename(source, target)
+        return count
+    # Otherwise the directory is either partially migrated already or is
+    # ambiguous with a bucket; move its files individually leaving any
+    # sub-directories (which must belong to a bucket) alone
+    count = 0
+    for filename in os.listdir(source):
+        if os.path.isfile(os.path.join(source, filename)):
+            if not os.path.exists(target):
+                os.makedirs(target)
+            os.rename(
+                os.path.join(source, filename),
+                os.path.join(target, filename))
+            count += 1
+    if not os.listdir(source):
+        os.rmdir(source)
+    return count
+
+def migrate(sample_attachments_dir, jobs=4):
+    """Migrates all sample directories, returning the number of files moved"""
+    pool = ThreadPool(jobs)
+    try:
+        result = 0
+        for kind in ('attachments', 'thumbs'):
+            root = os.path.join(sample_attachments_dir, kind)
+            result += sum(pool.imap_unordered(
+                lambda name: migrate_dir(root, name),
+                list(legacy_dirs(root)),
+                chunksize=100))
+        return result
+    finally:
+        pool.close()
+        pool.join()
+
+def main(argv=sys.argv):
+    parser = optparse.OptionParser(
+        usage='%prog [options] config_uri', description=__doc__.strip(),
+        prog=os.path.basename(argv[0]))
+    parser.add_option('-j', '--jobs', type='int', default=4,
+        help='the number of directories to move in parallel (default: 4)')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error('a configuration file is required')
+    config_uri = args[0]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    count = migrate(settings['sample_attachments_dir'], options.jobs)
+    print('Moved %d files' % count)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012 Dave Hughes.
+#
+# This file is part of samplesdb.
+#
+# samplesdb is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# samplesdb is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# samplesdb.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Provides a routine for constructing file responses from settings.
+
+Attachments and thumbnails are served from files on disk. By default the
+response is built around the WSGI server's ``wsgi.file_wrapper`` (which
+typically uses sendfile) falling back to a fixed-block iterator. Alternatively,
+if a front-end web-server is configured to serve the files directly, the
+response can consist of an X-Sendfile (Apache, lighttpd) or X-Accel-Redirect
+(nginx) header and nothing else, in which case no file content passes through
+the Python application at all.
+"""
+
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+    division,
+    )
+
+import os
+import mimetypes
+from urllib import quote
+
+from pyramid.response import Response, FileResponse
+
+
+__all__ = ['file_sender_from_settings', 'FileSender']
+
+
+class FileSender(object):
+    """Factory class which returns a response serving a file when called"""
+
+    methods = ('none', 'x-sendfile', 'x-accel-redirect')
+
+    def __init__(self, method='none', root=None, prefix='/'):
+        method = method.lower()
+        if not method in self.methods:
+            raise ValueError('Invalid sendfile method %s' % method)
+        if method == 'x-accel-redirect' and root is None:
+            raise ValueError('A root must be specified for X-Accel-Redirect')
+        self.method = method
+        self.root = os.path.abspath(root) if root is not None else None
+        self.prefix = prefix if prefix.endswith('/') else prefix + '/'
+
+    def serves(self, filename):
+        """
+        Returns True if filename can be served; with X-Accel-Redirect it must
+        lie under the root
+        """
+        if self.method != 'x-accel-redirect':
+            return True
+        relpath = os.path.relpath(os.path.abspath(filename), self.root)
+        return not relpath.startswith(os.pardir)
+
+    def _redirect_uri(self, filename):
+        """Returns the internal nginx URI corresponding to filename"""
+        if not self.serves(filename):
+            raise ValueError('%s does not lie under %s' % (filename, self.root))
+        relpath = os.path.relpath(filename, self.root)
+        # The path is percent-encoded (as UTF-8) so that names containing
+        # non-ASCII characters, or characters significant in a URI such as
+        # "?", "#" and "%", reach nginx intact
+        relpath = relpath.replace(os.sep, '/')
+        if isinstance(relpath, unicode):
+            relpath = relpath.encode('utf-8')
+        return str(self.prefix + quote(relpath, safe=b'/'))
+
+    def _etag(self, stat):
+        """Returns an entity tag derived from the file's mtime and size"""
+        return str('%x-%x' % (int(stat.st_mtime * 1000000), stat.st_size))
+
+    def __call__(
+            self, request, filename, content_type=None, content_encoding=None):
+        """
+        Return a response serving the file ``filename`` for ``request``.
+
+        If ``content_type`` is not specified it will be guessed from the
+        filename.
+        """
+        if content_type is None:
+            content_type, content_encoding = mimetypes.guess_type(
+                filename, strict=False)
+        if content_type is None:
+            content_type = 'application/octet-stream'
+        stat = os.stat(filename)
+        if self.method == 'none':
+            response = FileResponse(
+                filename, request,
+                content_type=str(content_type),
+                content_encoding=content_encoding and str(content_encoding))
+            response.etag = self._etag(stat)
+            return response
+        filename = os.path.abspath(filename)
+        response = Response(conditional_response=True)
+        response.content_type = str(content_type)
+        response.content_encoding = content_encoding and str(content_encoding)
+        response.last_modified = stat.st_mtime
+        response.etag = self._etag(stat)
+        if self.method == 'x-sendfile':
+            if isinstance(filename, unicode):
+                filename = filename.encode('utf-8')
+            response.headers[str('X-Sendfile')] = filename
+        else:
+            response.headers[str('X-Accel-Redirect')] = (
+                self._redirect_uri(filename))
+        # The front-end server will fill in the body and its length
+        del response.content_length
+        return response
+
+
+def file_sender_from_settings(settings):
+    """
+    Return a FileSender using settings supplied from a Paste configuration
+    file
+    """
+    return FileSender(
+        method=settings.get('sendfile.method', 'none'),
+        root=settings.get(
+            'sendfile.root', settings.get('sample_attachments_dir')),
+        prefix=settings.get('sendfile.prefix', '/'))
@@ -29,19 +29,46 @@ from __future__ import (
     )
 
 import os
+import io
+import csv
+import json
+import time
+import shutil
 import logging
+import tempfile
+from datetime import datetime
 
-from mock import Mock
+import transaction
+from mock import Mock, patch
 from nose.tools import assert_raises
 from webob.multidict import MultiDict
 from pyramid import testing
-from pyramid.httpexceptions import HTTPFound
+from pyramid.request import Request
+from pyramid.httpexceptions import (
+    HTTPFound,
+    HTTPNotFound,
+    HTTPBadRequest,
+    HTTPRequestEntityTooLarge,
+    )
 from pyramid_mailer.mailer import Mailer
 
 from samplesdb.image import can_resize, make_thumbnail
 from samplesdb.forms import css_add_class, css_del_class, FormRenderer
 from samplesdb.scripts.initializedb import init_instances
 from samplesdb.licenses import DummyLicensesFactory
+from samplesdb.sendfile import FileSender
+from samplesdb.blobs import BlobStore
+from samplesdb.uploads import *
+from samplesdb.workers import WorkerPools
+from samplesdb.exports import ExportJobs
+from samplesdb.importers import CollectionCsvImporter
+from samplesdb.exporters import (
+    CollectionCsvExporter,
+    CollectionXlsExporter,
+    CollectionJsonExporter,
+    NewlineTranslator,
+    to_char_format,
+    )
 from samplesdb.security import *
 from samplesdb.models import *
 from samplesdb.views.root import *
@@ -70,6 +97,132 @@ def test_image_resize():
     os.unlink(test_out)
 
 
+def test_file_sender_default():
+    test_img = os.path.join(os.path.dirname(__file__), 'static', 'pyramid.png')
+    request = testing.DummyRequest()
+    request.environ['wsgi.file_wrapper'] = Mock()
+    response = FileSender()(request, test_img)
+    assert response.content_type == 'image/png'
+    assert response.content_length == os.stat(test_img).st_size
+    assert response.etag
+    assert request.environ['wsgi.file_wrapper'].called
+    assert response.app_iter is request.environ['wsgi.file_wrapper'].return_value
+
+
+def test_file_sender_xsendfile():
+    test_img = os.path.join(os.path.dirname(__file__), 'static', 'pyramid.png')
+    response = FileSender('X-Sendfile')(testing.DummyRequest(), test_img)
+    assert response.content_type == 'image/png'
+    assert response.headers['X-Sendfile'] == os.path.abspath(test_img)
+    assert response.body == b''
+
+
+def test_file_sender_xaccel():
+    root = os.path.dirname(__file__)
+    test_img = os.path.join(root, 'static', 'pyramid.png')
+    sender = FileSender('x-accel-redirect', root=root, prefix='/protected')
+    response = sender(testing.DummyRequest(), test_img)
+    assert response.headers['X-Accel-Redirect'] == '/protected/static/pyramid.png'
+    assert_raises(ValueError, sender, testing.DummyRequest(), '/etc/passwd')
+    assert_raises(ValueError, FileSender, 'x-accel-redirect')
+
+
+def test_file_sender_unicode():
+    test_img = os.path.join(os.path.dirname(__file__), 'static', 'pyramid.png')
+    filename = '/srv/samplesdb/caf\xe9 #1?.png'
+    # Don't rely on the file-system encoding of the test environment
+    with patch('os.stat', return_value=os.stat(test_img)):
+        response = FileSender('x-sendfile')(testing.DummyRequest(), filename)
+        assert response.headers['X-Sendfile'] == filename.encode('utf-8')
+        sender = FileSender(
+            'x-accel-redirect', root='/srv/samplesdb', prefix='/protected')
+        response = sender(testing.DummyRequest(), filename)
+        assert response.headers['X-Accel-Redirect'] == (
+            '/protected/caf%C3%A9%20%231%3F.png')
+    assert_raises(ValueError, FileSender, 'foo')
+
+
+def test_asset_version():
+    from samplesdb.helpers import asset_version
+    version = asset_version('samplesdb:static/pyramid.png')
+    assert len(version) == 12
+    assert version == asset_version('samplesdb:static/pyramid.png')
+    assert version != asset_version('samplesdb:static/favicon.ico')
+
+
+def test_timezones():
+    from formencode import Invalid
+    from samplesdb.helpers import get_timezone
+    from samplesdb.validators import ValidTimezone
+    assert get_timezone('Europe/London').zone == 'Europe/London'
+    assert get_timezone('Europe/London') is get_timezone('Europe/London')
+    assert ValidTimezone().to_python('Europe/London') == 'Europe/London'
+    assert_raises(Invalid, ValidTimezone().to_python, 'Europe/Nowhere')
+
+
+def test_blob_store():
+    root = tempfile.mkdtemp()
+    try:
+        blobs = BlobStore(os.path.join(root, 'blobs'))
+        digest, size = blobs.store(io.BytesIO(b'foo'))
+        assert digest == '2c26b46b68ffc68ff99b453c1d30413413422d706483bfa0f98a5e886266e7ae'
+        assert size == 3
+        assert digest in blobs
+        assert blobs.store(io.BytesIO(b'foo')) == (digest, size)
+        with io.open(os.path.join(root, 'staged'), 'wb') as f:
+            f.write(b'foo')
+        assert blobs.store_file(os.path.join(root, 'staged')) == (digest, size)
+        assert not os.path.exists(os.path.join(root, 'staged'))
+        assert list(blobs) == [digest]
+        assert blobs.references(digest) == 0
+        blobs.link(digest, os.path.join(root, 'a', 'foo.txt'))
+        blobs.link(digest, os.path.join(root, 'b', 'foo.txt'))
+        assert blobs.references(digest) == 2
+        assert blobs.collect() == 0
+        # Storing the content again leaves the times of its links alone
+        link = os.path.join(root, 'a', 'foo.txt')
+        os.utime(link, (1000000000, 1000000000))
+        assert blobs.store(io.BytesIO(b'foo')) == (digest, size)
+        assert os.stat(link).st_mtime == 1000000000
+        os.unlink(os.path.join(root, 'a', 'foo.txt'))
+        os.unlink(os.path.join(root, 'b', 'foo.txt'))
+        assert blobs.collect(grace=60) == 0
+        assert blobs.collect(dry_run=True) == 3
+        assert digest in blobs
+        assert blobs.collect() == 3
+        assert digest not in blobs
+        assert os.listdir(os.path.dirname(blobs.path(digest))) == []
+    finally:
+        shutil.rmtree(root)
+
+
+def test_sample_path():
+    assert sample_path('/foo', 1) == '/foo/00/00/1'
+    assert sample_path('/foo', 12345) == '/foo/00/12/12345'
+    assert sample_path('/foo', 1234567) == '/foo/12/34/1234567'
+
+
+def test_migrate_attachments():
+    from samplesdb.scripts.migrateattachments import migrate
+    root = tempfile.mkdtemp()
+    try:
+        for sample_id in (1, 12, 12345):
+            path = os.path.join(root, 'attachments', '%d' % sample_id)
+            os.makedirs(path)
+            with io.open(os.path.join(path, 'foo.txt'), 'wb') as f:
+                f.write(b'foo')
+        assert migrate(root, jobs=2) == 3
+        for sample_id in (1, 12, 12345):
+            assert not os.path.exists(
+                os.path.join(root, 'attachments', '%d' % sample_id))
+            assert os.path.exists(os.path.join(
+                sample_path(os.path.join(root, 'attachments'), sample_id),
+                'foo.txt'))
+        assert migrate(root) == 0
+    finally:
+        shutil.rmtree(root)
+
+
 def test_css_add_class():
     assert css_add_class({}, 'foo') == {'class_': 'foo'}
     assert css_add_class({'class_': 'foo'}, 'foo') == {'class_': 'foo'}
@@ -82,6 +235,45 @@ def test_css_del_class():
     assert set(css_del_class({'class_': 'foo bar'}, 'baz')['class_'].split()) == set(('foo', 'bar'))
 
 
+def test_to_char_format():
+    assert to_char_format('%Y-%m-%d') == 'YYYY"-"MM"-"DD'
+    assert to_char_format('%d/%m/%y %H:%M') == 'DD"/"MM"/"YY" "HH24":"MI'
+    assert to_char_format('%Y "Q"%%') == 'YYYY" \\"Q\\"""%"'
+    assert to_char_format('%d %b %Y') is None
+
+
+def test_newline_translator():
+    output = io.BytesIO()
+    translator = NewlineTranslator(output, b'\r\n')
+    translator.write(b'foo,bar\n1,2\n')
+    assert output.getvalue() == b'foo,bar\r\n1,2\r\n'
+
+
+def test_compile_templates():
+    from samplesdb.views import compile_templates, get_macro, BOUND_MACROS
+    config = testing.setUp(settings={'reload_templates': True})
+    try:
+        assert compile_templates(config.registry) > 0
+        assert BOUND_MACROS == {}
+    finally:
+        testing.tearDown()
+    config = testing.setUp(settings={'reload_templates': False})
+    cache_dir = tempfile.mkdtemp()
+    try:
+        compile_templates(config.registry, cache_dir)
+        assert os.listdir(cache_dir)
+        assert get_macro('layout') is BOUND_MACROS['layout']
+    finally:
+        shutil.rmtree(cache_dir)
+        BOUND_MACROS.clear()
+        testing.tearDown()
+
+def test_quota_limited_input():
+    stream = QuotaLimitedInput(io.BytesIO(b'foo\nbar\n'), 6)
+    assert stream.readline() == b'foo\n'
+    assert_raises(QuotaExceeded, stream.read)
+
+
 class UnitFixture(object):
     """Fixture for unit-tests"""
 
@@ -94,6 +286,7 @@ class UnitFixture(object):
         self.config.registry['licenses'] = DummyLicensesFactory()
         self.config.registry.settings['site_title'] = 'TESTING'
         self.config.registry.settings['session.constant_csrf_token'] = '1234'
+        self.config.registry.settings['sample_attachments_dir'] = tempfile.mkdtemp()
         for route_name, route_url in ROUTES.items():
             self.config.add_route(route_name, route_url)
         engine = create_engine('sqlite://')
@@ -102,6 +295,7 @@ class UnitFixture(object):
         init_instances()
 
     def teardown(self):
+        shutil.rmtree(self.config.registry.settings['sample_attachments_dir'])
         DBSession.remove()
         testing.tearDown()
 
@@ -109,6 +303,16 @@ class UnitFixture(object):
 class FunctionalFixture(object):
     """Fixture for functional tests"""
 
+    @classmethod
+    def setup_class(cls):
+        # Compiling the templates is slow, so the cache is shared by the
+        # class's tests
+        cls.templates_cache_dir = tempfile.mkdtemp()
+
+    @classmethod
+    def teardown_class(cls):
+        shutil.rmtree(cls.templates_cache_dir)
+
     def setup(self):
         import DNS
         from samplesdb import main
@@ -116,7 +320,10 @@ class FunctionalFixture(object):
         settings = {
             'pyramid.includes':            'pyramid_beaker pyramid_mailer pyramid_tm',
             'licenses_cache_dir':          os.environ.get('TEMP', '.'),
+            'sample_attachments_dir':      tempfile.mkdtemp(),
+            'templates.cache_dir':         self.templates_cache_dir,
             'sqlalchemy.url':              'sqlite://',
+            'workers.processes':           '1',
             'site_title':                  'TESTING',
             'authn.type':                  'authtkt',
             'authn.hashalg':               'sha512',
@@ -135,6 +342,9 @@ class FunctionalFixture(object):
         DNS.DnsRequest = Mock(DNS.DnsRequest)
 
     def teardown(self):
+        self.test.app.registry['workers'].close()
+        shutil.rmtree(
+            self.test.app.registry.settings['sample_attachments_dir'])
         DBSession.remove()
 
 
@@ -444,6 +654,342 @@ class CollectionsViewUnitTests(UnitFixture):
                 filter(UserCollection.user_id==view.request.user.id).\
                 filter(Collection.name=='New Collection').first()
 
+    def test_collections_users_batched(self):
+        from formencode import Invalid
+        from sqlalchemy import event
+        users = []
+        for i in range(5):
+            user = User(
+                salutation='', given_name='User', surname='%d' % i,
+                limits_id='unlimited')
+            user.emails.append(EmailAddress(
+                email='user%d@example.com' % i, verified=datetime.utcnow()))
+            users.append(user)
+        DBSession.add_all(users)
+        # Committing returns the session's connection to the pool, so that the
+        # listener applies to the next (and expires the users)
+        transaction.commit()
+        validator = CollectionSchema.fields['users']
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        # The engine is discarded with the fixture, taking the listener
+        event.listen(DBSession.get_bind(), 'before_cursor_execute', count)
+        result = validator.to_python([
+            {'user': 'user%d@example.com' % i, 'role': 'editor'}
+            for i in range(5)])
+        assert len(statements) == 2
+        assert sorted(user.surname for user in result) == [
+            '0', '1', '2', '3', '4']
+        assert set(role.id for role in result.values()) == set(['editor'])
+        del statements[:]
+        data = validator.from_python(result)
+        assert len(statements) == 1
+        assert sorted(item['user'] for item in data) == [
+            'user%d@example.com' % i for i in range(5)]
+        assert_raises(Invalid, validator.to_python, [
+            {'user': 'user0@example.com', 'role': 'editor'},
+            {'user': 'nobody@example.com', 'role': 'editor'}])
+
+    def make_sample(self, view, attachment=None):
+        sample = Sample.create(
+            view.request.user, view.context.collection, description='Foo')
+        DBSession.add(sample)
+        DBSession.flush()
+        if attachment:
+            with io.open(attachment, 'rb') as f:
+                sample.attachments.create(os.path.basename(attachment), f)
+            sample.default_attachment = os.path.basename(attachment)
+        return sample
+
+    def test_collections_thumbs(self):
+        test_img = os.path.join(os.path.dirname(__file__), 'static', 'pyramid.png')
+        view = self.make_one(1)
+        with_thumb = self.make_sample(view, test_img)
+        without_thumb = self.make_sample(view)
+        urls = view.thumbs_urls([with_thumb, without_thumb])
+        assert len(urls) == 1
+        assert 'samples=%d' % with_thumb.id in urls[0]
+        assert 'samples=%d' % without_thumb.id not in urls[0]
+        view.request.GET = MultiDict(samples=str(with_thumb.id))
+        result = view.thumbs()
+        assert list(result.keys()) == [with_thumb.id]
+        assert result[with_thumb.id].startswith('data:image/jpeg;base64,')
+        assert 'must-revalidate' in view.request.response.headers['Cache-Control']
+
+    def test_collections_export_codes(self):
+        view = self.make_one(1)
+        for i in range(3):
+            sample = self.make_sample(view)
+            sample.codes['batch'] = 'B%d' % i
+            if i:
+                sample.codes['well'] = 'A%d' % i
+        DBSession.flush()
+        exporter = CollectionCsvExporter(Collection.by_id(1))
+        output = io.BytesIO()
+        exporter.export(output)
+        assert exporter.exported == 3
+        assert len(output.getvalue().splitlines()) == 3
+        today = datetime.utcnow().strftime('%Y-%m-%d').encode('ascii')
+        rows = list(csv.reader(io.BytesIO(output.getvalue())))
+        assert all(row[2] == today and row[3] == b'' for row in rows)
+        codes = [
+            exporter.columns.index('code_batch'),
+            exporter.columns.index('code_well')]
+        assert [[row[i] for i in codes] for row in rows] == [
+            [b'B0', b''], [b'B1', b'A1'], [b'B2', b'A2']]
+
+    def test_collections_export_newlines(self):
+        view = self.make_one(1)
+        self.make_sample(view).description = 'a\nb'
+        self.make_sample(view).description = 'say "hi\n"'
+        DBSession.flush()
+        exporter = CollectionCsvExporter(Collection.by_id(1))
+        exporter.columns = ['id', 'description']
+        exporter.lineterminator = 'dos'
+        expected = io.BytesIO()
+        exporter.export(expected)
+        assert b'"a\nb"\r\n' in expected.getvalue()
+        # COPY terminates records with newlines, which the fast path
+        # translates; its output is written in arbitrary chunks
+        exporter.lineterminator = 'unix'
+        copied = io.BytesIO()
+        exporter.export(copied)
+        output = io.BytesIO()
+        translator = NewlineTranslator(output, b'\r\n')
+        data = copied.getvalue()
+        for i in range(0, len(data), 3):
+            translator.write(data[i:i + 3])
+        assert output.getvalue() == expected.getvalue()
+
+    def test_collections_export_lineage(self):
+        view = self.make_one(1)
+        first = self.make_sample(view)
+        second = self.make_sample(view)
+        aliquots = first.split(view.request.user, view.context.collection, 2)
+        DBSession.add_all(aliquots)
+        combined = self.make_sample(view)
+        combined.parents.extend([second, aliquots[0]])
+        DBSession.flush()
+        expected = [
+            [str(first.id), b'', ' '.join(str(s.id) for s in aliquots)],
+            [str(second.id), b'', str(combined.id)],
+            [str(aliquots[0].id), str(first.id), str(combined.id)],
+            [str(aliquots[1].id), str(first.id), b''],
+            [str(combined.id), '%d %d' % (second.id, aliquots[0].id), b''],
+            ]
+        exporter = CollectionCsvExporter(Collection.by_id(1))
+        exporter.columns = ['id', 'parents', 'children']
+        output = io.BytesIO()
+        exporter.export(output)
+        assert list(csv.reader(io.BytesIO(output.getvalue()))) == expected
+        # Check the fallback for databases without an aggregate function
+        exporter._aggregate = lambda lineage: None
+        output = io.BytesIO()
+        exporter.export(output)
+        assert list(csv.reader(io.BytesIO(output.getvalue()))) == expected
+
+    def test_collections_export_xls(self):
+        view = self.make_one(1)
+        for i in range(5):
+            self.make_sample(view).codes['batch'] = 'B%d' % i
+        transaction.commit()
+        exporter = CollectionXlsExporter(Collection.by_id(1))
+        exporter.sheet_rows = 3
+        sheets = []
+        add_sheet = exporter._add_sheet
+        def record_sheet(workbook, number, titles, style):
+            sheets.append(number)
+            assert titles[0] == 'Identifier'
+            return add_sheet(workbook, number, titles, style)
+        exporter._add_sheet = record_sheet
+        output = io.BytesIO()
+        exporter.export(output)
+        data = output.getvalue()
+        # Five rows at two rows (plus titles) per sheet
+        assert sheets == [1, 2, 3]
+        assert data.startswith(b'\xd0\xcf\x11\xe0')
+        assert len(data) % 512 == 0
+
+    def test_collections_export_jsonl(self):
+        view = self.make_one(1)
+        parent = self.make_sample(view)
+        parent.codes['batch'] = 'B0'
+        children = parent.split(view.request.user, view.context.collection, 2)
+        DBSession.add_all(children)
+        DBSession.flush()
+        transaction.commit()
+        exporter = CollectionJsonExporter(Collection.by_id(1))
+        output = io.BytesIO()
+        exporter.export(output)
+        records = [json.loads(line) for line in output.getvalue().splitlines()]
+        assert len(records) == 3
+        assert [r['parents'] for r in records] == [
+            [], [records[0]['id']], [records[0]['id']]]
+        assert records[0]['children'] == [r['id'] for r in records[1:]]
+        assert [r['code_batch'] for r in records] == ['B0', None, None]
+        assert records[0]['created'].startswith(
+            datetime.utcnow().strftime('%Y-%m-%dT'))
+        assert records[0]['destroyed'] is not None
+        assert records[1]['destroyed'] is None
+
+    def test_collections_export_job(self):
+        jobs = ExportJobs(os.path.join(
+            self.config.registry.settings['sample_attachments_dir'],
+            'exports'))
+        jobs._pool = Mock()
+        self.config.registry['exports'] = jobs
+        self.config.registry['sendfile'] = FileSender()
+        view = self.make_one(1)
+        for i in range(2):
+            self.make_sample(view)
+        transaction.commit()
+        def submit():
+            view = self.make_one(1)
+            view.request.method = 'POST'
+            view.request.POST.update(dict(
+                format='csv', delimiter='comma', lineterminator='unix',
+                quotechar='double', quoting='minimal', doublequote='1',
+                dateformat='%Y-%m-%d', _came_from=view.request.referer))
+            view.request.POST.add('columns', 'id')
+            view.request.POST.add('columns', 'description')
+            result = view.export()
+            assert isinstance(result, HTTPFound)
+            return jobs.by_id(result.location.rsplit('/', 1)[-1])
+        job = submit()
+        assert job.state['status'] == 'queued'
+        # Identical exports coalesce while the job is pending
+        assert submit() is job
+        assert jobs._pool.apply_async.call_count == 1
+        run, args = jobs._pool.apply_async.call_args[0]
+        run(*args)
+        assert job.state['status'] == 'complete'
+        assert job.state['exported'] == job.state['total'] == 2
+        view = self.make_one(1)
+        view.request.matchdict['job_id'] = job.id
+        response = view.export_download()
+        assert response.content_type == 'text/csv'
+        assert response.etag == job.key
+        assert b''.join(response.app_iter).splitlines()[0].endswith(b',Foo')
+        # Results outside the root of X-Accel-Redirect are served directly
+        self.config.registry['sendfile'] = FileSender(
+            'x-accel-redirect', root=os.path.dirname(__file__))
+        response = view.export_download()
+        assert 'X-Accel-Redirect' not in response.headers
+        assert b''.join(response.app_iter).splitlines()[0].endswith(b',Foo')
+        # Repeating the export is served from the cache until the collection
+        # changes
+        cached = submit()
+        assert cached is not job
+        assert cached.status == 'complete'
+        assert cached.filename == job.filename
+        assert jobs._pool.apply_async.call_count == 1
+        Collection.by_id(1).all_samples[0].description = 'Bar'
+        transaction.commit()
+        changed = submit()
+        assert changed.status == 'queued'
+        assert changed.filename != job.filename
+        assert jobs._pool.apply_async.call_count == 2
+        # Expired results are removed
+        jobs.expiry = -1
+        submit()
+        assert jobs.by_id(job.id) is None
+        assert not os.path.exists(job.filename)
+
+    def test_collections_export_cache_eviction(self):
+        root = os.path.join(
+            self.config.registry.settings['sample_attachments_dir'],
+            'exports')
+        jobs = ExportJobs(root, cache_size=10)
+        jobs._pool = Mock()
+        collection = Collection.by_id(1)
+        now = time.time()
+        for i, options in enumerate((dict(a=1), dict(a=2), dict(a=3))):
+            job = jobs.submit(collection, 'csv', options)
+            with io.open(job.filename, 'wb') as f:
+                f.write(b'x' * 4)
+            os.utime(job.filename, (now - 10 + i, now - 10 + i))
+        jobs._pending.clear()
+        # Re-using the first result makes the second the least recently used
+        assert jobs.submit(collection, 'csv', dict(a=1)).status == 'complete'
+        jobs._evict()
+        assert jobs.submit(collection, 'csv', dict(a=1)).status == 'complete'
+        assert jobs.submit(collection, 'csv', dict(a=2)).status == 'queued'
+        assert jobs.submit(collection, 'csv', dict(a=3)).status == 'complete'
+
+    def test_collections_import(self):
+        view = self.make_one(1)
+        parent = self.make_sample(view)
+        collection = Collection.by_id(1)
+        version = collection.version
+        importer = CollectionCsvImporter(collection, view.request.user)
+        importer.import_file(io.BytesIO(
+            b'\xef\xbb\xbfDescription,Location,Created,Parents,code_batch\r\n'
+            b'Foo,Freezer,2013-01-02,,B1\r\n'
+            b',Freezer,,,B2\r\n'
+            b'Bar,Freezer,02/01/2013,,B3\r\n'
+            b'Baz,,,%d,\r\n'
+            b'Quux,,,999,\r\n' % parent.id), batch_size=2)
+        assert importer.imported == 2
+        assert [line for (line, message) in importer.errors] == [3, 4, 6]
+        assert collection.version > version
+        samples = DBSession.query(Sample).\
+            filter(Sample.id > parent.id).order_by(Sample.id).all()
+        assert [s.description for s in samples] == ['Foo', 'Baz']
+        assert samples[0].created.date() == datetime(2013, 1, 2).date()
+        assert dict(samples[0].codes) == {'batch': 'B1'}
+        assert dict(samples[1].codes) == {}
+        assert samples[1].parents == [parent]
+        assert [entry.event for entry in samples[1].log] == ['create']
+        assert collection.code_names == ['batch']
+
+    def test_collections_import_bad_header(self):
+        view = self.make_one(1)
+        collection = Collection.by_id(1)
+        for data in (b'', b'\r\nFoo\r\n', b'Descr\xe9ption\r\nFoo\r\n'):
+            importer = CollectionCsvImporter(collection, view.request.user)
+            assert importer.import_file(io.BytesIO(data)) == 0
+            assert [line for (line, message) in importer.errors] == [1]
+
+    def test_collections_code_names(self):
+        view = self.make_one(1)
+        collection = Collection.by_id(1)
+        first = self.make_sample(view)
+        first.codes['batch'] = 'B1'
+        first.codes['well'] = 'A1'
+        second = self.make_sample(view)
+        second.codes['batch'] = 'B2'
+        DBSession.flush()
+        assert collection.code_names == ['batch', 'well']
+        counts = lambda: dict(DBSession.query(
+            CollectionCodeName.name, CollectionCodeName.samples))
+        assert counts() == {'batch': 2, 'well': 1}
+        del first.codes['well']
+        DBSession.flush()
+        assert counts() == {'batch': 2}
+        DBSession.delete(first)
+        DBSession.flush()
+        assert counts() == {'batch': 1}
+        # Moving a sample moves its codes to the other collection
+        other = Collection(name='Other', owner='Administrator')
+        DBSession.add(other)
+        second.codes['well'] = 'A2'
+        DBSession.flush()
+        second.collection = other
+        DBSession.flush()
+        assert collection.code_names == []
+        assert other.code_names == ['batch', 'well']
+        second.collection = collection
+        second.codes['plate'] = 'P1'
+        DBSession.flush()
+        assert other.code_names == []
+        assert counts() == {'batch': 1, 'plate': 1, 'well': 1}
+        # Codes the session hasn't loaded are counted on deletion too
+        DBSession.expire(second)
+        DBSession.delete(second)
+        DBSession.flush()
+        assert collection.code_names == []
+
     def test_collections_view(self):
         view = self.make_one(1)
         result = view.view()
@@ -454,6 +1000,296 @@ class CollectionsViewUnitTests(UnitFixture):
         assert 'samples' in result
 
 
+class SampleAttachmentsUnitTests(UnitFixture):
+    def make_one(self):
+        sample = Sample.create(
+            User.by_email('admin@example.com'), Collection.by_id(1),
+            description='Foo')
+        DBSession.add(sample)
+        DBSession.flush()
+        return sample
+
+    def test_attachments_create(self):
+        sample = self.make_one()
+        assert len(sample.attachments) == 0
+        sample.attachments.create('foo.txt', io.BytesIO(b'foo'))
+        assert 'foo.txt' in sample.attachments
+        assert list(sample.attachments) == ['foo.txt']
+        assert sample.attachments.mime_type('foo.txt') == 'text/plain'
+        with sample.attachments.open('foo.txt') as f:
+            assert f.read() == b'foo'
+        sample.attachments.remove('foo.txt')
+        assert 'foo.txt' not in sample.attachments
+
+    def test_download_attachment_missing(self):
+        self.config.registry['sendfile'] = FileSender()
+        sample = self.make_one()
+        sample.attachments.create('foo.txt', io.BytesIO(b'foo'))
+        for query in ('/', '/?attachment=', '/?attachment=.',
+                '/?attachment=bar.txt', '/?attachment=..%2F..%2Ffoo.txt'):
+            request = Request.blank(query)
+            request.registry = self.config.registry
+            view = SamplesView(Mock(sample=sample), request)
+            assert_raises(HTTPNotFound, view.download_attachment)
+        assert sample.attachments.filename('../foo.txt') is None
+
+    def test_attachments_ingest(self):
+        sample = self.make_one()
+        staged = os.path.join(
+            self.config.registry.settings['sample_attachments_dir'], 'staged')
+        with io.open(staged, 'wb') as f:
+            f.write(b'foo')
+        inode = os.stat(staged).st_ino
+        sample.attachments.ingest('foo.txt', staged)
+        assert not os.path.exists(staged)
+        assert os.stat(sample.attachments.filename('foo.txt')).st_ino == inode
+
+    def test_attachments_replace_thumb(self):
+        sample = self.make_one()
+        svg = b'<svg xmlns="http://www.w3.org/2000/svg"/>'
+        self.make_one().attachments.create('old.svg', io.BytesIO(svg))
+        sample.attachments.create('foo.svg', io.BytesIO(svg + b'\n'))
+        assert sample.attachments.thumb_filename('foo.svg') is not None
+        # The replacement content is an existing (older) blob, so only the
+        # removal of the thumbnail prevents the old one being served
+        sample.attachments.replace('foo.svg', io.BytesIO(svg))
+        with sample.attachments.thumb_open('foo.svg') as f:
+            assert f.read() == svg
+
+    def test_attachments_dedupe(self):
+        sample1 = self.make_one()
+        sample2 = self.make_one()
+        sample1.attachments.create('foo.txt', io.BytesIO(b'foo'))
+        sample2.attachments.create('bar.txt', io.BytesIO(b'foo'))
+        assert len(list(sample1.attachments.blobs)) == 1
+        assert os.path.samefile(
+            sample1.attachments.filename('foo.txt'),
+            sample2.attachments.filename('bar.txt'))
+
+    def test_split_copy_attachments(self):
+        sample = self.make_one()
+        sample.attachments.create('foo.txt', io.BytesIO(b'foo'))
+        sample.default_attachment = 'foo.txt'
+        aliquots = sample.split(
+            User.by_email('admin@example.com'), sample.collection, 2,
+            copy_attachments=True)
+        assert len(aliquots) == 2
+        for aliquot in aliquots:
+            assert list(aliquot.attachments) == ['foo.txt']
+            assert aliquot.default_attachment == 'foo.txt'
+            assert os.path.samefile(
+                sample.attachments.filename('foo.txt'),
+                aliquot.attachments.filename('foo.txt'))
+
+    def test_chunked_upload(self):
+        sample = self.make_one()
+        root = os.path.join(
+            self.config.registry.settings['sample_attachments_dir'], 'uploads')
+        upload = ChunkedUpload.create(root, sample.id, 1, '../foo.txt', 6)
+        assert upload.filename == 'foo.txt'
+        assert ChunkedUpload.by_id(root, upload.id).size == 6
+        assert upload.write(0, io.BytesIO(b'foo'), 3) == 3
+        assert_raises(
+            UploadOffsetError, upload.write, 0, io.BytesIO(b'bar'), 3)
+        assert_raises(
+            UploadChecksumError, upload.write, 3, io.BytesIO(b'bar'), 3,
+            md5='0' * 32)
+        assert upload.offset == 3
+        assert_raises(UploadError, upload.commit, sample.attachments)
+        upload.write(3, io.BytesIO(b'bar'), 3,
+            md5='37b51d194a7513e45b56f6524f2d51f2')
+        assert upload.complete
+        upload.commit(sample.attachments)
+        assert ChunkedUpload.by_id(root, upload.id) is None
+        with sample.attachments.open('foo.txt') as f:
+            assert f.read() == b'foobar'
+
+    def test_upload_chunk(self):
+        sample = self.make_one()
+        root = os.path.join(
+            self.config.registry.settings['sample_attachments_dir'], 'uploads')
+        upload = ChunkedUpload.create(root, sample.id, 1, 'foo.txt', 6)
+        def put(body, **headers):
+            request = Request.blank(
+                '/', method='PUT', body=body, headers=headers)
+            request.registry = self.config.registry
+            request.matchdict = {'upload_id': upload.id}
+            request.user = Mock(id=1, storage_remaining=4)
+            return SamplesView(Mock(sample=sample), request).upload_chunk()
+        assert_raises(
+            HTTPBadRequest, put, b'foo', **{str('Content-MD5'): str('abc')})
+        assert put(b'foo')['offset'] == 3
+        assert_raises(HTTPRequestEntityTooLarge, put, b'bar')
+        assert upload.offset == 3
+
+    def test_upload_commit_quota(self):
+        sample = self.make_one()
+        user = User.by_email('admin@example.com')
+        user.limits.storage_limit = user.storage_used + 10
+        DBSession.flush()
+        root = os.path.join(
+            self.config.registry.settings['sample_attachments_dir'], 'uploads')
+        def request(upload, method, body=b''):
+            DBSession.expire(user)
+            request = Request.blank('/', method=method, body=body)
+            request.registry = self.config.registry
+            request.matchdict = {'upload_id': upload.id}
+            request.user = user
+            return SamplesView(Mock(sample=sample), request)
+        uploads = [
+            ChunkedUpload.create(root, sample.id, user.id, name, 6)
+            for name in ('foo.txt', 'bar.txt')]
+        # Chunks are checked against the bytes staged by other uploads
+        request(uploads[0], 'PUT', b'foobar').upload_chunk()
+        assert_raises(
+            HTTPRequestEntityTooLarge,
+            request(uploads[1], 'PUT', b'foobar').upload_chunk)
+        # Uploads which each fit the quota can't all be committed
+        uploads[1].write(0, io.BytesIO(b'foobar'), 6)
+        request(uploads[0], 'POST').upload_commit()
+        assert_raises(
+            HTTPRequestEntityTooLarge, request(uploads[1], 'POST').upload_commit)
+        assert list(sample.attachments) == ['foo.txt']
+        assert sample.collection.storage_used == 6
+
+    def test_storage_accounting(self):
+        sample = self.make_one()
+        user = User.by_email('admin@example.com')
+        used = user.storage_used
+        sample.attachments.create('foo.txt', io.BytesIO(b'foo'))
+        sample.attachments.create('bar.txt', io.BytesIO(b'foobar'))
+        assert sample.collection.storage_used == 9
+        sample.attachments.replace('bar.txt', io.BytesIO(b'bar'))
+        sample.attachments.remove('foo.txt')
+        assert sample.collection.storage_used == 3
+        DBSession.expire(user)
+        assert user.storage_used == used + 3
+        assert user.storage_remaining == user.limits.storage_limit - used - 3
+
+    def test_storage_moved(self):
+        sample = self.make_one()
+        sample.attachments.create('foo.txt', io.BytesIO(b'foo'))
+        collection = sample.collection
+        other = Collection(name='Other', owner='Administrator')
+        DBSession.add(other)
+        DBSession.flush()
+        sample.collection = other
+        DBSession.flush()
+        assert collection.storage_used == 0
+        assert other.storage_used == 3
+
+    def test_storage_backfill(self):
+        from samplesdb.scripts.accountstorage import account
+        root = self.config.registry.settings['sample_attachments_dir']
+        sample = self.make_one()
+        sample.attachments.create('foo.txt', io.BytesIO(b'foo'))
+        sample.attachments.create('bar.txt', io.BytesIO(b'foobar'))
+        # Simulate attachments stored before the counter existed
+        sample.collection.storage_used = 0
+        DBSession.flush()
+        sample.attachments.remove('foo.txt')
+        assert sample.collection.storage_used == 0
+        assert account(root, dry_run=True) == {1: 6}
+        assert sample.collection.storage_used == 0
+        assert account(root, jobs=2) == {1: 6}
+        DBSession.expire(sample.collection)
+        assert sample.collection.storage_used == 6
+
+    def test_attachments_create_all(self):
+        sample = self.make_one()
+        test_img = os.path.join(
+            os.path.dirname(__file__), 'static', 'pyramid.png')
+        svg = b'<svg xmlns="http://www.w3.org/2000/svg"/>'
+        workers = WorkerPools(threads=2, processes=1)
+        workers.start()
+        try:
+            with io.open(test_img, 'rb') as f:
+                sample.attachments.create_all([
+                    ('foo.txt', io.BytesIO(b'foo')),
+                    ('bar.png', io.BytesIO(f.read())),
+                    ('foo.txt', io.BytesIO(b'bar')),
+                    ('baz.svg', io.BytesIO(svg)),
+                    ], workers)
+        finally:
+            workers.close()
+        assert list(sample.attachments) == ['bar.png', 'baz.svg', 'foo.txt']
+        with sample.attachments.open('foo.txt') as f:
+            assert f.read() == b'bar'
+        assert sample.collection.storage_used == (
+            3 + len(svg) + os.stat(test_img).st_size)
+        assert sample.attachments.thumb_updated('bar.png') is not None
+        with sample.attachments.thumb_open('baz.svg') as f:
+            assert f.read() == svg
+        # Thumbnails are renamed into place, leaving no temporary files
+        assert sorted(os.listdir(sample.attachments.thumb_path)) == [
+            'bar.png.jpg', 'baz.svg.svg']
+
+    def test_attachments_compressed(self):
+        self.config.registry.settings['sample_attachments_compress'] = 'true'
+        self.config.registry['sendfile'] = FileSender()
+        sample = self.make_one()
+        content = b'well,value\n' + b'A1,0.123\n' * 1000
+        sample.attachments.create('plate.csv', io.BytesIO(content))
+        sample.attachments.create('plate.csv.gz', io.BytesIO(b'foo'))
+        assert sample.attachments.compressed('plate.csv')
+        assert not sample.attachments.compressed('plate.csv.gz')
+        assert sample.attachments.content_encoding('plate.csv') == 'gzip'
+        assert sample.attachments.size('plate.csv') < len(content) // 10
+        with sample.attachments.open('plate.csv') as f:
+            assert f.read() == content
+        request = Request.blank('/?attachment=plate.csv')
+        request.registry = self.config.registry
+        view = SamplesView(Mock(sample=sample), request)
+        response = view.download_attachment()
+        assert response.content_encoding is None
+        assert response.body == content
+        request.headers['Accept-Encoding'] = str('gzip, deflate')
+        response = view.download_attachment()
+        assert response.content_encoding == 'gzip'
+        assert response.vary == ('Accept-Encoding',)
+        assert len(response.body) == sample.attachments.size('plate.csv')
+
+    def test_gc_attachments(self):
+        from samplesdb.scripts.gcattachments import collect
+        root = self.config.registry.settings['sample_attachments_dir']
+        sample = self.make_one()
+        sample.attachments.create('foo.txt', io.BytesIO(b'foo'))
+        sample.attachments.create('bar.png', io.BytesIO(b'bar'))
+        thumb = sample.attachments._thumb_filename('bar.png')
+        os.makedirs(os.path.dirname(thumb))
+        with io.open(thumb, 'wb') as f:
+            f.write(b'thumb')
+        sample.attachments.remove('foo.txt')
+        os.unlink(sample.attachments.filename('bar.png'))
+        orphan = sample_path(os.path.join(root, 'attachments'), 1000)
+        os.makedirs(orphan)
+        with io.open(os.path.join(orphan, 'baz.txt'), 'wb') as f:
+            f.write(b'bazbaz')
+        # A sample still in the old flat layout keeps its thumbnails
+        flat = self.make_one()
+        for kind, filename in (
+                ('attachments', 'quux.png'), ('thumbs', 'quux.png.jpg')):
+            path = os.path.join(root, kind, '%d' % flat.id)
+            os.makedirs(path)
+            with io.open(os.path.join(path, filename), 'wb') as f:
+                f.write(b'quux')
+        flat_thumb = os.path.join(
+            root, 'thumbs', '%d' % flat.id, 'quux.png.jpg')
+        assert collect(root, grace=60) == {
+            'attachments': 0, 'thumbs': 0, 'stale thumbs': 0,
+            'uploads': 0, 'blobs': 0}
+        expected = {
+            'attachments': 6, 'thumbs': 0, 'stale thumbs': 5,
+            'uploads': 0, 'blobs': 6}
+        assert collect(root, grace=0, dry_run=True) == expected
+        assert os.path.exists(orphan)
+        assert collect(root, grace=0, jobs=2, batch_size=1) == expected
+        assert not os.path.exists(orphan)
+        assert not os.path.exists(thumb)
+        assert os.path.exists(flat_thumb)
+        assert list(sample.attachments.blobs) == []
+
+
 class SiteFunctionalTest(FunctionalFixture):
     def last_verify_url(self):
         # Returns the last verification URL "sent" to a user
@@ -513,6 +1349,14 @@ class SiteFunctionalTest(FunctionalFixture):
         res = self.test.get('/')
         res.click(href='/faq')
 
+    def test_static_versioned(self):
+        res = self.test.get('/')
+        assert '/static/foundation4/css/app.css?v=' in res
+        res = self.test.get('/static/pyramid.png')
+        assert 'immutable' not in res.headers['Cache-Control']
+        res = self.test.get('/static/pyramid.png?v=1234')
+        assert 'immutable' in res.headers['Cache-Control']
+
     def test_csrf(self):
         res = self.test.get('/login')
         assert 'Login' in res
@@ -716,7 +1560,21 @@ class SiteFunctionalTest(FunctionalFixture):
         pass
 
     def test_sample_attach_good(self):
-        pass
+        self.test_login_good()
+        with transaction.manager:
+            sample = Sample.create(
+                User.by_email('admin@example.com'),
+                DBSession.query(Collection).first(), description='Foo')
+            DBSession.add(sample)
+            DBSession.flush()
+            sample_id = sample.id
+        res = self.test.get('/samples/%d' % sample_id)
+        form = [f for f in res.forms.values() if 'add-attachment' in f.action][0]
+        form['attachments'] = ('foo.txt', b'foo bar baz')
+        res = form.submit()
+        assert res.status_int == 302
+        assert 'foo.txt' in res.follow()
+        assert Sample.by_id(sample_id).collection.storage_used == 11
 
     def test_sample_split_bad(self):
         pass
@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012 Dave Hughes.
+#
+# This file is part of samplesdb.
+#
+# samplesdb is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# samplesdb is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# samplesdb.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Implements resumable, chunked uploads of sample attachments.
+
+An upload is created with the attachment's name and total size. Its content
+is then appended in chunks, each of which must start at the upload's current
+offset (the size of its staging file), so a client whose connection drops can
+simply ask for the offset and continue from there. Once all content has
+arrived the upload is committed, moving the staging file into the sample's
+attachments without copying it.
+
+Staging files live beneath sample_attachments_dir/uploads so that they reside
+on the same file-system as the attachments themselves.
+
+The module also provides a tween which counts the bodies of upload requests
+against the user's remaining storage quota as they are read, aborting the
+request as soon as the quota is exceeded.
+"""
+
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+    division,
+    )
+
+import os
+import io
+import json
+import time
+import errno
+import hashlib
+
+import transaction
+from pyramid.httpexceptions import HTTPRequestEntityTooLarge
+
+
+__all__ = [
+    'UploadError',
+    'UploadOffsetError',
+    'UploadChecksumError',
+    'QuotaExceeded',
+    'ChunkedUpload',
+    'QuotaLimitedInput',
+    'quota_tween_factory',
+    ]
+
+# Allowance for the form fields and MIME headers surrounding the files in a
+# multipart upload; file content itself is checked precisely by the views
+QUOTA_SLACK = 64 * 1024
+
+
+class UploadError(Exception):
+    "Base class for chunked upload errors"
+
+
+class UploadOffsetError(UploadError):
+    "Error raised when a chunk does not start at the upload's current offset"
+
+
+class UploadChecksumError(UploadError):
+    "Error raised when a chunk's content does not match its checksum"
+
+
+class QuotaExceeded(UploadError):
+    "Error raised when an upload exceeds the user's storage quota"
+
+
+class ChunkedUpload(object):
+    """Represents a partially complete upload of an attachment"""
+
+    block_size = 1024**2
+
+    def __init__(self, root, id, sample_id, user_id, filename, size, created):
+        self.root = root
+        self.id = id
+        self.sample_id = sample_id
+        self.user_id = user_id
+        self.filename = filename
+        self.size = size
+        self.created = created
+
+    @classmethod
+    def create(cls, root, sample_id, user_id, filename, size):
+        """Create a new upload of size bytes for the specified sample"""
+        if size < 0:
+            raise UploadError('Upload size cannot be negative')
+        if not os.path.exists(root):
+            os.makedirs(root)
+        upload = cls(
+            root, os.urandom(16).encode('hex'), sample_id, user_id,
+            os.path.basename(filename), size, time.time())
+        io.open(upload.staging_filename, 'wb').close()
+        with io.open(upload._state_filename, 'wb') as f:
+            f.write(json.dumps(dict(
+                sample_id=upload.sample_id,
+                user_id=upload.user_id,
+                filename=upload.filename,
+                size=upload.size,
+                created=upload.created,
+                )).encode('utf-8'))
+        return upload
+
+    @classmethod
+    def by_id(cls, root, id):
+        """Return the upload with id ``id`` or None if it does not exist"""
+        if not id.isalnum():
+            return None
+        try:
+            with io.open(os.path.join(root, '%s.json' % id), 'rb') as f:
+                state = json.loads(f.read().decode('utf-8'))
+        except IOError, exc:
+            if exc.errno == errno.ENOENT:
+                return None
+            raise
+        return cls(root, id, **state)
+
+    @classmethod
+    def all(cls, root):
+        """Yields all uploads in progress"""
+        if os.path.exists(root):
+            for name in os.listdir(root):
+                if name.endswith('.json'):
+                    upload = cls.by_id(root, name[:-len('.json')])
+                    if upload is not None:
+                        yield upload
+
+    @classmethod
+    def staged(cls, root, user_id, exclude=None):
+        """
+        Returns the bytes staged by the uploads in progress of the specified
+        user, other than the upload with id ``exclude``
+        """
+        return sum(
+            upload.offset for upload in cls.all(root)
+            if upload.user_id == user_id and upload.id != exclude)
+
+    @property
+    def staging_filename(self):
+        return os.path.join(self.root, self.id)
+
+    @property
+    def _state_filename(self):
+        return os.path.join(self.root, '%s.json' % self.id)
+
+    @property
+    def offset(self):
+        """Returns the number of bytes received so far"""
+        return os.stat(self.staging_filename).st_size
+
+    @property
+    def complete(self):
+        return self.offset == self.size
+
+    def write(self, offset, file_obj, length, md5=None):
+        """
+        Append length bytes read from file_obj at the specified offset,
+        returning the new offset.
+
+        If the md5 hex-digest is specified, the chunk is verified against it as
+        it is written and discarded if it does not match.
+        """
+        if offset != self.offset:
+            raise UploadOffsetError(
+                'Chunk starts at %d but upload is at %d' % (offset, self.offset))
+        if offset + length > self.size:
+            raise UploadError(
+                'Chunk ends at %d beyond the upload size %d' % (
+                    offset + length, self.size))
+        digest = hashlib.md5()
+        with io.open(self.staging_filename, 'r+b') as f:
+            f.seek(offset)
+            try:
+                remaining = length
+                while remaining > 0:
+                    data = file_obj.read(min(remaining, self.block_size))
+                    if not data:
+                        raise UploadError(
+                            'Chunk ended %d bytes early' % remaining)
+                    digest.update(data)
+                    f.write(data)
+                    remaining -= len(data)
+                if md5 is not None and digest.hexdigest() != md5.lower():
+                    raise UploadChecksumError('Chunk checksum does not match')
+            except:
+                # Discard the chunk so the client can resume from its start
+                f.truncate(offset)
+                raise
+        return offset + length
+
+    def commit(self, attachments):
+        """Move the completed upload into the SampleAttachments instance"""
+        if not self.complete:
+            raise UploadError(
+                'Upload is incomplete (%d of %d bytes)' % (
+                    self.offset, self.size))
+        attachments.ingest(self.filename, self.staging_filename)
+        os.unlink(self._state_filename)
+
+    def abort(self):
+        """Discard the upload"""
+        for filename in (self.staging_filename, self._state_filename):
+            if os.path.exists(filename):
+                os.unlink(filename)
+
+
+class QuotaLimitedInput(object):
+    """Wraps a WSGI input stream, raising QuotaExceeded after limit bytes"""
+
+    def __init__(self, stream, limit):
+        self.stream = stream
+        self.limit = limit
+        self.count = 0
+
+    def _check(self, data):
+        self.count += len(data)
+        if self.count > self.limit:
+            raise QuotaExceeded(
+                'Upload exceeds the remaining storage quota of %d bytes' % (
+                    self.limit - QUOTA_SLACK))
+        return data
+
+    def read(self, size=-1):
+        return self._check(self.stream.read(size))
+
+    def readline(self, size=-1):
+        return self._check(self.stream.readline(size))
+
+    def readlines(self, hint=-1):
+        return [self._check(line) for line in self.stream.readlines(hint)]
+
+    def __iter__(self):
+        for line in self.stream:
+            yield self._check(line)
+
+
+def quota_tween_factory(handler, registry):
+    """
+    Returns a tween limiting the bodies of uploads (multipart POSTs and PUTs)
+    by authenticated users to their remaining storage quota.
+
+    Requests declaring a Content-Length beyond the quota are refused before
+    any of the body is read; others are refused as soon as the quota is
+    crossed while reading. Either way the connection is closed rather than
+    draining the remainder of the body.
+    """
+    def quota_tween(request):
+        if request.method == 'PUT' or (
+                request.method == 'POST' and
+                request.content_type == 'multipart/form-data'):
+            user = request.user
+            if user is not None:
+                limit = user.storage_remaining + QUOTA_SLACK
+                if (request.content_length or 0) > limit:
+                    return quota_exceeded(QuotaExceeded(
+                        'Upload exceeds the remaining storage quota of %d '
+                        'bytes' % user.storage_remaining))
+                request.environ['wsgi.input'] = QuotaLimitedInput(
+                    request.environ['wsgi.input'], limit)
+        try:
+            return handler(request)
+        except QuotaExceeded, exc:
+            # The tween runs within the request's transaction, which must not
+            # commit whatever the view did before the quota was crossed
+            transaction.doom()
+            return quota_exceeded(exc)
+    return quota_tween
+
+def quota_exceeded(exc):
+    response = HTTPRequestEntityTooLarge(str(exc))
+    response.headers[str('Connection')] = str('close')
+    return response
@@ -35,7 +35,6 @@ from __future__ import (
 import csv
 from datetime import datetime
 
-import pytz
 from formencode import (
     FancyValidator,
     Schema,
@@ -47,7 +46,10 @@ from formencode.foreach import ForEach
 from pyramid.threadlocal import get_current_registry
 
 from samplesdb.views import MARKUP_LANGUAGES
+from samplesdb.helpers import TIMEZONE_NAMES
+from samplesdb.exporters import EXPORTERS
 from samplesdb.models import (
+    DBSession,
     EmailAddress,
     UserLimit,
     User,
@@ -72,18 +74,85 @@ class SubFormSchema(BaseSchema):
     pass
 
 
+class BatchValidator(FancyValidator):
+    """
+    Base class for validators which convert values with a query.
+
+    When used in the schema of a ForEachDict's items, the values of all items
+    are converted together by ``_to_python_batch`` (or ``_from_python_batch``)
+    before the items are validated, and descendants should use ``_batched``
+    to find the results rather than querying once per item. The batch
+    methods receive a set of values, and return a dict mapping every one of
+    them to its conversion (or None, if it has none).
+    """
+
+    def _to_python_batch(self, values):
+        return {}
+
+    def _from_python_batch(self, values):
+        return {}
+
+    def _batched(self, value, state):
+        """
+        Returns the batch conversion of value, raising KeyError if value was
+        not converted in a batch
+        """
+        try:
+            return state.batches[self][value]
+        except AttributeError:
+            raise KeyError(value)
+
+
+class BatchState(object):
+    """
+    Wraps the state passed to ForEachDict, adding the batch conversions of
+    its items' values for BatchValidator
+    """
+
+    def __init__(self, state, batches):
+        self._state = state
+        self.batches = batches
+
+    def __getattr__(self, name):
+        return getattr(self._state, name)
+
+
 class ForEachDict(ForEach):
     def __init__(self, *args, **kw):
         super(ForEachDict, self).__init__(*args, **kw)
         self.key_name = kw['key_name']
         self.value_name = kw['value_name']
 
+    def _batches(self, items, method):
+        """
+        Returns a dict mapping the BatchValidator fields of the item schema to
+        the result of calling their method with the fields' values in items
+        """
+        result = {}
+        for validator in self.validators:
+            for name, field in getattr(validator, 'fields', {}).items():
+                if isinstance(field, BatchValidator):
+                    values = set()
+                    for item in items:
+                        if not hasattr(item, 'get'):
+                            continue
+                        value = item.get(name)
+                        if isinstance(value, basestring) and field.strip:
+                            value = value.strip()
+                        if value is not None and value != '':
+                            values.add(value)
+                    if values:
+                        result[field] = getattr(field, method)(values)
+        return result
+
     def validate_python(self, value, state):
         if not hasattr(value, 'items'):
             if not hasattr(value, 'iteritems'):
                 raise Invalid('value is not dict-like', value, state)
 
     def _to_python(self, value, state):
+        items = value if isinstance(value, (list, tuple)) else [value]
+        state = BatchState(state, self._batches(items, '_to_python_batch'))
         value = super(ForEachDict, self)._to_python(value, state)
         result = {}
         try:
@@ -117,6 +186,7 @@ class ForEachDict(ForEach):
             iterator = value.items()
         for key, value in iterator:
             result.append({self.key_name: key, self.value_name: value})
+        state = BatchState(state, self._batches(result, '_from_python_batch'))
         return super(ForEachDict, self)._from_python(result, state)
 
 
@@ -212,6 +282,33 @@ class ValidSampleLocation(validators.UnicodeString):
             not_empty=False, max=Sample.__table__.c.location.type.length)
 
 
+class ValidSampleCreated(FancyValidator):
+    def __init__(self, dateformat='%Y-%m-%d'):
+        super(ValidSampleCreated, self).__init__(
+            not_empty=False, strip=True, if_empty=None)
+        self.dateformat = dateformat
+
+    def _to_python(self, value, state):
+        try:
+            return datetime.strptime(value, self.dateformat)
+        except ValueError, e:
+            raise Invalid(str(e), value, state)
+
+
+class ValidSampleParents(FancyValidator):
+    def __init__(self):
+        super(ValidSampleParents, self).__init__(
+            not_empty=False, strip=True, if_empty=[])
+
+    def _to_python(self, value, state):
+        try:
+            return [int(sample_id) for sample_id in value.split()]
+        except ValueError:
+            raise Invalid(
+                'Parents must be a space separated list of sample ids',
+                value, state)
+
+
 class ValidSampleAliquots(validators.Int):
     def __init__(self):
         super(ValidSampleAliquots, self).__init__(
@@ -222,6 +319,10 @@ class ValidSampleAliquant(validators.Bool):
     pass
 
 
+class ValidSampleCopyAttachments(validators.Bool):
+    pass
+
+
 class ValidSampleNotes(validators.UnicodeString):
     def __init__(self):
         super(ValidSampleNotes, self).__init__(not_empty=False)
@@ -247,7 +348,7 @@ class ValidLogMessage(validators.UnicodeString):
 
 class ValidTimezone(validators.OneOf):
     def __init__(self):
-        super(ValidTimezone, self).__init__(pytz.all_timezones)
+        super(ValidTimezone, self).__init__(TIMEZONE_NAMES, hideList=True)
 
 
 class ValidMarkupLanguage(validators.OneOf):
@@ -302,7 +403,7 @@ class ValidEmailForAccountType(validators.FormValidator):
                     self.email_address_field: self.error_msg})
 
 
-class ValidRole(FancyValidator):
+class ValidRole(BatchValidator):
     def __init__(self):
         super(ValidRole, self).__init__(not_empty=True, strip=True)
 
@@ -313,14 +414,24 @@ class ValidRole(FancyValidator):
     def _from_python(self, value, state):
         return value.id
 
+    def _to_python_batch(self, values):
+        result = dict((value, None) for value in values)
+        result.update(
+            (role.id, role) for role in
+            DBSession.query(Role).filter(Role.id.in_(values)))
+        return result
+
     def _to_python(self, value, state):
-        result = Role.by_id(value)
+        try:
+            result = self._batched(value, state)
+        except KeyError:
+            result = Role.by_id(value)
         if result is None:
             raise Invalid('Invalid role', value, state)
         return result
 
 
-class ValidUser(FancyValidator):
+class ValidUser(BatchValidator):
     def __init__(self, not_empty=True):
         super(ValidUser, self).__init__(not_empty=not_empty, strip=True)
 
@@ -328,11 +439,37 @@ class ValidUser(FancyValidator):
         if not isinstance(value, User):
             raise Invalid('value is not a User', value, state)
 
+    def _from_python_batch(self, values):
+        result = dict((value, None) for value in values)
+        users = dict((user.id, user) for user in values)
+        for user_id, email in DBSession.query(
+                EmailAddress.user_id, EmailAddress.email).\
+                filter(EmailAddress.user_id.in_(users)).\
+                filter(EmailAddress.verified != None):
+            if result[users[user_id]] is None:
+                result[users[user_id]] = email
+        return result
+
     def _from_python(self, value, state):
-        return value.verified_emails[0].email
+        try:
+            result = self._batched(value, state)
+        except KeyError:
+            result = None
+        return result or value.verified_emails[0].email
+
+    def _to_python_batch(self, values):
+        result = dict((value, None) for value in values)
+        result.update(
+            DBSession.query(EmailAddress.email, User).join(User).\
+                filter(EmailAddress.email.in_(values)).\
+                filter(EmailAddress.verified != None))
+        return result
 
     def _to_python(self, value, state):
-        result = User.by_email(value)
+        try:
+            result = self._batched(value, state)
+        except KeyError:
+            result = User.by_email(value)
         if result is None:
             raise Invalid('No users have address %s' % value, value, state)
         return result
@@ -376,7 +513,7 @@ class ValidSample(FancyValidator):
 
 class ValidExportFormat(validators.OneOf):
     def __init__(self):
-        super(ValidExportFormat, self).__init__(['csv', 'excel'])
+        super(ValidExportFormat, self).__init__(EXPORTERS.keys())
 
 
 class ValidExportColumns(validators.Set):
@@ -24,6 +24,8 @@ from __future__ import (
     division,
     )
 
+import os
+import sys
 from datetime import datetime
 
 import pytz
@@ -33,10 +35,14 @@ import webhelpers.date
 import webhelpers.number
 import webhelpers.html.builder
 import webhelpers.html.converters
+from chameleon.loader import ModuleLoader
 from pyramid.decorator import reify
-from pyramid.renderers import get_renderer
+from pyramid.events import NewResponse, subscriber
+from pyramid.renderers import get_renderer, RendererHelper
 from pyramid.security import has_permission
 
+from samplesdb.helpers import CACHE_FOREVER, asset_version
+
 
 MARKUP_LANGUAGES = {
     'text'    : 'Plain Text',
@@ -135,43 +141,116 @@ ALLOWED_ATTRS = {
     'ul'         : LIST_ATTRS,
 }
 
+# Maps the names of BaseView's macro properties to the template and name of
+# the macro
+MACROS = {
+    'layout':              ('layout.pt',             'layout'),
+    'top_banner':          ('top_banner.pt',         'top_banner'),
+    'top_bar':             ('top_bar.pt',            'top_bar'),
+    'flashes':             ('flashes.pt',            'flashes'),
+    'open_licenses_panel': ('open_licenses.pt',      'open_licenses'),
+    'collection_license':  ('collection_license.pt', 'collection_license'),
+    }
+
+# The macros bound by compile_templates
+BOUND_MACROS = {}
+
+
+def compile_templates(registry, cache_dir=None):
+    """
+    Compiles all templates with the renderers of registry (so that they are
+    the templates the views will use), optionally caching the compiled
+    modules in cache_dir, and binds the macros of BaseView unless templates
+    are to be reloaded when changed
+    """
+    BOUND_MACROS.clear()
+    loader = None
+    if cache_dir:
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        loader = ModuleLoader(cache_dir)
+    root = os.path.join(os.path.dirname(__file__), os.pardir, 'templates')
+    templates = {}
+    for path, dirs, files in os.walk(root):
+        for filename in files:
+            if filename.endswith('.pt'):
+                # Templates are named relative to this package, exactly as
+                # the views name them, so the same renderers are cached
+                name = '/'.join(
+                    ['..', 'templates'] +
+                    os.path.relpath(
+                        os.path.join(path, filename), root).split(os.sep))
+                template = RendererHelper(
+                    name=name, package=sys.modules[__name__],
+                    registry=registry).renderer.implementation()
+                if loader is not None:
+                    template.loader = loader
+                template.cook_check()
+                templates[name] = template
+    if not registry.settings.get('reload_templates', False):
+        for attr, (filename, macro) in MACROS.items():
+            BOUND_MACROS[attr] = templates[
+                '../templates/' + filename].macros[macro]
+    return len(templates)
+
+
+def get_macro(attr):
+    """Returns the macro for the named property of BaseView"""
+    try:
+        return BOUND_MACROS[attr]
+    except KeyError:
+        filename, macro = MACROS[attr]
+        renderer = get_renderer('../templates/' + filename)
+        return renderer.implementation().macros[macro]
+
+
+@subscriber(NewResponse)
+def cache_versioned_assets(event):
+    # Static assets are linked with a content hash in their query string (see
+    # BaseView.static_url) so any asset requested with one can be cached
+    # indefinitely; unversioned requests retain the static view's default
+    request = event.request
+    response = event.response
+    if (
+            response.status_int == 200 and
+            request.path_info.startswith('/static/') and
+            'v' in request.GET):
+        response.headers[str('Cache-Control')] = str(
+            'public, max-age=%d, immutable' % CACHE_FOREVER)
+        response.expires = None
+
 
 class BaseView(object):
     """Abstract base class for view handlers"""
 
     # This base class defines a whole load of properties and methods which are
     # intended as utility routines / properties for use within templates. First
-    # are reified properties containing template macros...
+    # are reified properties containing template macros (bound at startup by
+    # compile_templates)...
 
     @reify
     def layout(self):
-        renderer = get_renderer('../templates/layout.pt')
-        return renderer.implementation().macros['layout']
+        return get_macro('layout')
 
     @reify
     def top_banner(self):
-        renderer = get_renderer('../templates/top_banner.pt')
-        return renderer.implementation().macros['top_banner']
+        return get_macro('top_banner')
 
     @reify
     def top_bar(self):
-        renderer = get_renderer('../templates/top_bar.pt')
-        return renderer.implementation().macros['top_bar']
+        return get_macro('top_bar')
 
     @reify
     def flashes(self):
-        renderer = get_renderer('../templates/flashes.pt')
-        return renderer.implementation().macros['flashes']
+        return get_macro('flashes')
 
     @reify
     def open_licenses_panel(self):
-        renderer = get_renderer('../templates/open_licenses.pt')
-        return renderer.implementation().macros['open_licenses']
+        return get_macro('open_licenses_panel')
 
     @reify
     def collection_license(self):
-        renderer = get_renderer('../templates/collection_license.pt')
-        return renderer.implementation().macros['collection_license']
+        return get_macro('collection_license')
 
     @reify
     def markup_languages(self):
@@ -187,6 +266,35 @@ class BaseView(object):
     def has_permission(self, permission):
         return has_permission(permission, self.context, self.request)
 
+    def static_url(self, path):
+        "Returns the URL of a static asset, versioned by its content"
+        return self.request.static_url(
+            path, _query={'v': asset_version(path)})
+
+    def cache_thumbnail(self, response):
+        "Sets the Cache-Control header of a response containing thumbnails"
+        # Thumbnails of open collections may be stored by shared caches but
+        # otherwise must only be cached by the requesting browser
+        scope = 'public' if self.context.collection.license.is_open else 'private'
+        if 'v' in self.request.GET:
+            # Thumbnails are linked with a version derived from the original's
+            # modification time (see thumb_url) so any change to the
+            # attachment results in a new URL
+            response.headers[str('Cache-Control')] = str(
+                '%s, max-age=%d, immutable' % (scope, CACHE_FOREVER))
+        else:
+            response.headers[str('Cache-Control')] = str(
+                '%s, max-age=0, must-revalidate' % scope)
+
+    def thumb_url(self, sample, attachment):
+        "Returns the URL of an attachment's thumbnail, versioned by its mtime"
+        updated = sample.attachments.updated(attachment)
+        return self.request.route_url(
+            'samples_attachment_thumb',
+            sample_id=sample.id,
+            attachment=attachment,
+            _query={'v': updated.strftime('%Y%m%d%H%M%S%f')} if updated else {})
+
     def literal(self, *args):
         "Indicates that the content is literal markup"
         return webhelpers.html.builder.literal(*args)
@@ -25,11 +25,8 @@ from __future__ import (
     )
 
 import logging
-from datetime import datetime
 
-import pytz
 from pyramid.view import view_config, forbidden_view_config
-from pyramid.decorator import reify
 from pyramid.security import remember, forget
 from pyramid.httpexceptions import HTTPFound, HTTPNotFound
 from pyramid.renderers import render
@@ -37,6 +34,7 @@ from pyramid_mailer.message import Message
 from formencode import validators
 
 from samplesdb.views import BaseView
+from samplesdb.helpers import TIMEZONE_CHOICES
 from samplesdb.security import authenticate, MANAGE_ACCOUNT
 from samplesdb.forms import (
     Form,
@@ -109,16 +107,9 @@ class AccountView(BaseView):
     def __init__(self, request):
         self.request = request
 
-    @reify
+    @property
     def timezones(self):
-        # Build a nice sorted list of (timezone_id, description) for the 
-        now = datetime(2000, 1, 1, 0, 0, 0)
-        return list(sorted((
-            (tz, '(UTC%s) %s' % (
-                pytz.timezone(tz).localize(now).strftime('%z'), tz.replace('_', ' ')))
-            for tz in pytz.common_timezones
-            if tz != 'GMT'),
-            key=lambda t: (pytz.timezone(t[0]).localize(now), t[0])))
+        return TIMEZONE_CHOICES
 
     @view_config(
         route_name='account_login',
@@ -28,13 +28,20 @@ from __future__ import (
     division,
     )
 
+import os
+import io
+import base64
+import hashlib
+
 from pyramid.view import view_config
 from pyramid.decorator import reify
-from pyramid.httpexceptions import HTTPFound
+from pyramid.httpexceptions import HTTPFound, HTTPNotFound
 
 from samplesdb.helpers import slugify
+from samplesdb.sendfile import FileSender
 from samplesdb.views import BaseView
-from samplesdb.exporters import CollectionCsvExporter
+from samplesdb.exporters import EXPORTERS, CollectionCsvExporter
+from samplesdb.importers import CollectionCsvImporter
 from samplesdb.forms import (
     Form,
     FormRenderer,
@@ -48,6 +55,7 @@ from samplesdb.validators import (
     ValidCollectionName,
     ValidCollectionOwner,
     ValidCollectionLicense,
+    ValidExportFormat,
     ValidExportColumns,
     ValidCsvDelimiter,
     ValidCsvDoubleQuotes,
@@ -73,6 +81,11 @@ from samplesdb.models import (
     )
 
 
+# The maximum number of thumbnails returned by a single request to the
+# collections_thumbs view
+THUMBS_LIMIT = 100
+
+
 class CollectionUserSchema(SubFormSchema):
     user = ValidUser()
     role = ValidRole()
@@ -86,7 +99,8 @@ class CollectionSchema(FormSchema):
                 key_name='user', value_name='role')
 
 
-class CollectionCsvExportSchema(FormSchema):
+class CollectionExportSchema(FormSchema):
+    format = ValidExportFormat()
     columns = ValidExportColumns()
     delimiter = ValidCsvDelimiter()
     doublequote = ValidCsvDoubleQuotes()
@@ -96,6 +110,10 @@ class CollectionCsvExportSchema(FormSchema):
     dateformat = ValidDateTimeFormat()
 
 
+class CollectionImportSchema(FormSchema):
+    dateformat = ValidDateTimeFormat()
+
+
 class CollectionCreateSchema(CollectionSchema):
     pass
 
@@ -135,6 +153,29 @@ class CollectionsView(BaseView):
             )
         return licenses
 
+    def thumbs_urls(self, samples):
+        """
+        Returns a list of URLs for the collections_thumbs view which together
+        cover the default attachments of all specified samples
+        """
+        samples = [sample for sample in samples if sample.default_attachment]
+        result = []
+        for i in range(0, len(samples), THUMBS_LIMIT):
+            batch = samples[i:i + THUMBS_LIMIT]
+            # Version the batch by the modification times of its originals in
+            # the same manner as BaseView.thumb_url
+            version = hashlib.md5()
+            for sample in batch:
+                updated = sample.attachments.updated(sample.default_attachment)
+                version.update(('%d:%s:%s\n' % (
+                    sample.id, sample.default_attachment, updated)).encode('utf-8'))
+            result.append(self.request.route_url(
+                'collections_thumbs',
+                collection_id=self.context.collection.id,
+                _query=[('samples', sample.id) for sample in batch] +
+                    [('v', version.hexdigest()[:12])]))
+        return result
+
     @view_config(
         route_name='collections_index',
         renderer='../templates/collections/index.pt',
@@ -209,22 +250,124 @@ class CollectionsView(BaseView):
         form = Form(
             self.request,
             obj=exporter,
-            schema=CollectionCsvExportSchema)
+            defaults=dict(format='csv'),
+            schema=CollectionExportSchema)
         if form.validate():
-            form.bind(exporter)
-            response = self.request.response
-            response.content_type = b'text/csv'
-            response.headers.add(
-                str('Content-Disposition'),
-                str('attachment; filename=%s.csv' % slugify(
-                    self.context.collection.name,
-                    default='collection-%d' % self.context.collection.id)))
-            exporter.export(response.body_file)
-            return response
+            # The export runs in the background; the options are the
+            # attributes the job binds to its exporter
+            options = dict(
+                (name, value)
+                for (name, value) in form.data.items()
+                if not name.startswith('_') and name != 'format')
+            job = self.request.registry['exports'].submit(
+                self.context.collection, form.data['format'], options)
+            return HTTPFound(location=self.request.route_url(
+                'collections_export_job',
+                collection_id=self.context.collection.id, job_id=job.id))
         return dict(
             exporter=exporter,
+            formats=sorted(
+                (format, exporter_class.title)
+                for (format, exporter_class) in EXPORTERS.items()),
+            form=FormRenderer(form))
+
+    @view_config(
+        route_name='collections_import',
+        renderer='../templates/collections/import.pt',
+        permission=EDIT_COLLECTION)
+    def import_samples(self):
+        importer = CollectionCsvImporter(
+            self.context.collection, self.request.user)
+        form = Form(
+            self.request,
+            obj=importer,
+            schema=CollectionImportSchema,
+            multipart=True)
+        storage = self.request.POST.get('file')
+        if form.validate() and hasattr(storage, 'file'):
+            form.bind(importer)
+            importer.import_file(storage.file)
+        return dict(
+            importer=importer,
             form=FormRenderer(form))
 
+    def _export_job(self):
+        job = self.request.registry['exports'].by_id(
+            self.request.matchdict['job_id'])
+        if job is None or job.collection_id != self.context.collection.id:
+            raise HTTPNotFound()
+        return job
+
+    @view_config(
+        route_name='collections_export_job',
+        renderer='../templates/collections/export_job.pt',
+        permission=VIEW_COLLECTION)
+    def export_job(self):
+        return dict(job=self._export_job())
+
+    @view_config(
+        route_name='collections_export_status',
+        renderer='json',
+        permission=VIEW_COLLECTION)
+    def export_status(self):
+        return self._export_job().state
+
+    @view_config(
+        route_name='collections_export_download',
+        permission=VIEW_COLLECTION)
+    def export_download(self):
+        job = self._export_job()
+        if job.status != 'complete' or not os.path.exists(job.filename):
+            raise HTTPNotFound()
+        exporter_class = EXPORTERS[job.format]
+        sender = self.request.registry['sendfile']
+        if not sender.serves(job.filename):
+            # exports.dir may lie outside the front-end server's root, in
+            # which case the result is served by the application itself
+            sender = FileSender()
+        response = sender(
+            self.request, job.filename,
+            content_type=exporter_class.content_type)
+        # The key identifies the content precisely, unlike the file's mtime
+        # which changes whenever the cached result is reused
+        response.etag = str(job.key)
+        response.content_disposition = str(
+            'attachment; filename=%s.%s' % (
+                slugify(
+                    self.context.collection.name,
+                    default='collection-%d' % self.context.collection.id),
+                exporter_class.extension))
+        return response
+
+    @view_config(
+        route_name='collections_thumbs',
+        renderer='json',
+        permission=VIEW_COLLECTION)
+    def thumbs(self):
+        # Authorization is performed once for the whole batch here, rather
+        # than once per thumbnail by samples_attachment_thumb
+        sample_ids = [
+            int(sample_id)
+            for sample_id in self.request.GET.getall('samples')
+            if sample_id.isdigit()
+            ][:THUMBS_LIMIT]
+        result = {}
+        if sample_ids:
+            samples = DBSession.query(Sample).\
+                filter(Sample.collection_id==self.context.collection.id).\
+                filter(Sample.id.in_(sample_ids)).\
+                filter(Sample.default_attachment!=None)
+            for sample in samples:
+                attachments = sample.attachments
+                filename = attachments.thumb_filename(sample.default_attachment)
+                if filename is not None:
+                    with io.open(filename, 'rb') as f:
+                        result[sample.id] = 'data:%s;base64,%s' % (
+                            attachments.thumb_mime_type(sample.default_attachment),
+                            base64.b64encode(f.read()))
+        self.cache_thumbnail(self.request.response)
+        return result
+
     @view_config(
         route_name='collections_view',
         renderer='../templates/collections/view.pt',
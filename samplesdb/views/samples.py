@@ -28,8 +28,21 @@ from __future__ import (
     division,
     )
 
+import os
+import io
+import base64
+
 from pyramid.view import view_config
-from pyramid.httpexceptions import HTTPFound
+from pyramid.decorator import reify
+from pyramid.response import Response, FileIter
+from pyramid.httpexceptions import (
+    HTTPFound,
+    HTTPNotFound,
+    HTTPBadRequest,
+    HTTPConflict,
+    HTTPRequestEntityTooLarge,
+    )
+from webob.byterange import ContentRange
 
 from samplesdb.views import BaseView
 from samplesdb.forms import (
@@ -49,6 +62,7 @@ from samplesdb.validators import (
     ValidSampleNotes,
     ValidSampleAliquots,
     ValidSampleAliquant,
+    ValidSampleCopyAttachments,
     ValidLogMessage,
     ValidCodeName,
     ValidCodeValue,
@@ -62,6 +76,11 @@ from samplesdb.models import (
     Sample,
     SampleLogEntry,
     )
+from samplesdb.uploads import (
+    ChunkedUpload,
+    UploadError,
+    UploadOffsetError,
+    )
 
 
 class SampleLogEntrySchema(SubFormSchema):
@@ -104,6 +123,7 @@ class SampleSplitSchema(FormSchema):
     location = ValidSampleLocation()
     aliquots = ValidSampleAliquots()
     aliquant = ValidSampleAliquant()
+    copy_attachments = ValidSampleCopyAttachments()
 
 
 class SampleCombineSchema(FormSchema):
@@ -119,6 +139,20 @@ class SamplesView(BaseView):
         self.context = context
         self.request = request
 
+    def _within_quota(self, storages):
+        """Checks the total size of the uploaded files against the quota"""
+        # The quota tween has already limited the request body as a whole;
+        # this excludes the form fields and MIME headers from the count
+        size = 0
+        for storage in storages:
+            storage.file.seek(0, io.SEEK_END)
+            size += storage.file.tell()
+        if size > self.request.user.storage_remaining:
+            self.request.session.flash(
+                'Attachments exceed your remaining storage quota')
+            return False
+        return True
+
     @view_config(
         route_name='samples_create',
         renderer='../templates/samples/create.pt',
@@ -129,16 +163,19 @@ class SamplesView(BaseView):
             schema=SampleCreateSchema,
             variable_decode=True,
             multipart=True)
-        if form.validate():
+        storages = [
+            storage for storage in self.request.POST.getall('attachments')
+            if hasattr(storage, 'file')]
+        if form.validate() and self._within_quota(storages):
             # XXX Check for EDIT_COLLECTION on selected collection
             # XXX Should be using form collection below
             new_sample = form.bind(
                 Sample.create(self.request.user, self.context.collection))
             DBSession.add(new_sample)
             DBSession.flush() # to generate sample.id
-            for storage in self.request.POST.getall('attachments'):
-                if storage:
-                    new_sample.attachments.create(storage.filename, storage.file)
+            new_sample.attachments.create_all(
+                ((storage.filename, storage.file) for storage in storages),
+                self.request.registry['workers'])
             return HTTPFound(
                 location=self.request.route_url(
                     'samples_view', sample_id=new_sample.id))
@@ -220,6 +257,7 @@ class SamplesView(BaseView):
             aliquots = sample.split(
                 self.request.user, form.data['collection'],
                 form.data['aliquots'], form.data['aliquant'],
+                form.data['copy_attachments'],
                 location=form.data['location'])
             for aliquot in aliquots:
                 DBSession.add(aliquot)
@@ -241,8 +279,13 @@ class SamplesView(BaseView):
         route_name='samples_add_attachment',
         permission=EDIT_COLLECTION)
     def add_attachment(self):
-        for storage in self.request.POST.getall('attachments'):
-            self.context.sample.attachments.create(storage.filename, storage.file)
+        storages = [
+            storage for storage in self.request.POST.getall('attachments')
+            if hasattr(storage, 'file')]
+        if self._within_quota(storages):
+            self.context.sample.attachments.create_all(
+                ((storage.filename, storage.file) for storage in storages),
+                self.request.registry['workers'])
         return HTTPFound(
             location=self.request.route_url(
                 'samples_view',
@@ -272,18 +315,194 @@ class SamplesView(BaseView):
                 sample_id=self.context.sample.id,
                 _anchor='attachments'))
 
+    @view_config(
+        route_name='samples_download_attachment',
+        permission=VIEW_COLLECTION)
+    def download_attachment(self):
+        attachments = self.context.sample.attachments
+        attachment = self.request.params.get('attachment', '')
+        filename = attachments.filename(attachment)
+        if filename is None:
+            raise HTTPNotFound()
+        compressed = attachments.compressed(attachment)
+        if compressed and not (
+                'Accept-Encoding' in self.request.headers and
+                'gzip' in self.request.accept_encoding):
+            # The client can't handle the stored (gzip) encoding, so
+            # decompress the content on the fly
+            response = Response(
+                app_iter=FileIter(attachments.open(attachment)),
+                content_type=str(attachments.mime_type(attachment)),
+                conditional_response=True)
+            response.last_modified = os.stat(filename).st_mtime
+        else:
+            response = self.request.registry['sendfile'](
+                self.request, filename,
+                content_type=attachments.mime_type(attachment),
+                content_encoding=attachments.content_encoding(attachment))
+        if compressed:
+            response.vary = (str('Accept-Encoding'),)
+        response.content_disposition = (
+            'attachment; filename="%s"' % os.path.basename(filename)
+            ).encode('utf-8')
+        return response
+
     @view_config(
         route_name='samples_attachment_thumb',
         permission=VIEW_COLLECTION)
     def attachment_thumb(self):
-        response = self.request.response
         attachments = self.context.sample.attachments
         attachment = self.request.matchdict['attachment']
-        response.content_type = attachments.thumb_mime_type(attachment)
-        response.content_length = attachments.thumb_filesize(attachment)
-        response.app_iter = attachments.thumb_open(attachment)
+        filename = attachments.thumb_filename(attachment)
+        if filename is None:
+            raise HTTPNotFound()
+        response = self.request.registry['sendfile'](
+            self.request, filename,
+            content_type=attachments.thumb_mime_type(attachment))
+        self.cache_thumbnail(response)
         return response
 
+    @reify
+    def uploads_dir(self):
+        return os.path.join(
+            self.request.registry.settings['sample_attachments_dir'],
+            'uploads')
+
+    def _upload(self):
+        upload = ChunkedUpload.by_id(
+            self.uploads_dir, self.request.matchdict['upload_id'])
+        if (
+                upload is None or
+                upload.sample_id != self.context.sample.id or
+                upload.user_id != self.request.user.id):
+            raise HTTPNotFound()
+        return upload
+
+    def _upload_state(self, upload):
+        return dict(
+            id=upload.id,
+            filename=upload.filename,
+            size=upload.size,
+            offset=upload.offset,
+            url=self.request.route_url(
+                'samples_upload',
+                sample_id=self.context.sample.id,
+                upload_id=upload.id),
+            commit_url=self.request.route_url(
+                'samples_upload_commit',
+                sample_id=self.context.sample.id,
+                upload_id=upload.id),
+            )
+
+    @view_config(
+        route_name='samples_uploads',
+        request_method='POST',
+        renderer='json',
+        permission=EDIT_COLLECTION)
+    def upload_create(self):
+        try:
+            filename = self.request.POST['filename']
+            size = int(self.request.POST['size'])
+        except (KeyError, ValueError):
+            raise HTTPBadRequest('filename and size must be specified')
+        user = self.request.user
+        if size + ChunkedUpload.staged(
+                self.uploads_dir, user.id) > user.storage_remaining:
+            raise HTTPRequestEntityTooLarge('Upload exceeds storage quota')
+        try:
+            upload = ChunkedUpload.create(
+                self.uploads_dir, self.context.sample.id, user.id,
+                filename, size)
+        except UploadError, exc:
+            raise HTTPBadRequest(str(exc))
+        return self._upload_state(upload)
+
+    @view_config(
+        route_name='samples_upload',
+        request_method='GET',
+        renderer='json',
+        permission=EDIT_COLLECTION)
+    def upload_status(self):
+        return self._upload_state(self._upload())
+
+    @view_config(
+        route_name='samples_upload',
+        request_method='PUT',
+        renderer='json',
+        permission=EDIT_COLLECTION)
+    def upload_chunk(self):
+        upload = self._upload()
+        length = self.request.content_length
+        if length is None:
+            raise HTTPBadRequest('Content-Length must be specified')
+        if 'Content-Range' in self.request.headers:
+            content_range = ContentRange.parse(
+                self.request.headers['Content-Range'])
+            if (
+                    content_range is None or
+                    content_range.stop - content_range.start != length):
+                raise HTTPBadRequest('Invalid Content-Range')
+            offset = content_range.start
+        else:
+            try:
+                offset = int(self.request.GET.get('offset', upload.offset))
+            except ValueError:
+                raise HTTPBadRequest('Invalid offset')
+        # Staged content isn't counted against the quota until it is
+        # committed, so check what the user's uploads will have staged after
+        # this chunk against what remains
+        user = self.request.user
+        staged = ChunkedUpload.staged(self.uploads_dir, user.id, upload.id)
+        if staged + upload.offset + length > user.storage_remaining:
+            raise HTTPRequestEntityTooLarge('Upload exceeds storage quota')
+        md5 = self.request.headers.get('Content-MD5')
+        if md5 is not None:
+            try:
+                md5 = base64.b64decode(md5).encode('hex')
+            except TypeError:
+                raise HTTPBadRequest('Invalid Content-MD5')
+        try:
+            # Chunks are streamed straight from the request body into the
+            # staging file
+            upload.write(offset, self.request.body_file, length, md5)
+        except UploadOffsetError, exc:
+            raise HTTPConflict(str(exc))
+        except UploadError, exc:
+            raise HTTPBadRequest(str(exc))
+        return self._upload_state(upload)
+
+    @view_config(
+        route_name='samples_upload',
+        request_method='DELETE',
+        renderer='json',
+        permission=EDIT_COLLECTION)
+    def upload_abort(self):
+        self._upload().abort()
+        return {}
+
+    @view_config(
+        route_name='samples_upload_commit',
+        request_method='POST',
+        renderer='json',
+        permission=EDIT_COLLECTION)
+    def upload_commit(self):
+        upload = self._upload()
+        # Other uploads (or attachments) may have used the quota since this
+        # upload's chunks were checked
+        if upload.size > self.request.user.storage_remaining:
+            raise HTTPRequestEntityTooLarge('Upload exceeds storage quota')
+        try:
+            upload.commit(self.context.sample.attachments)
+        except UploadError, exc:
+            raise HTTPConflict(str(exc))
+        return dict(
+            attachment=upload.filename,
+            url=self.request.route_url(
+                'samples_download_attachment',
+                sample_id=self.context.sample.id,
+                _query={'attachment': upload.filename}),
+            )
+
     @view_config(
         route_name='samples_add_log',
         permission=EDIT_COLLECTION)
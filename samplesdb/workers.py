@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# vim: set et sw=4 sts=4:
+
+# Copyright 2012 Dave Hughes.
+#
+# This file is part of samplesdb.
+#
+# samplesdb is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# samplesdb is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS FOR
+# A PARTICULAR PURPOSE.  See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License along with
+# samplesdb.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Provides pools of workers shared by all requests.
+
+A thread pool handles I/O bound work, such as storing the content of several
+uploaded attachments at once. A process pool handles CPU bound work, such as
+generating thumbnails, which would otherwise contend for the interpreter lock
+with the threads serving requests. The process pool should be started before
+the application starts any threads of its own (as forking a threaded process
+copies only the forking thread, along with any locks the others held);
+otherwise both pools are created on first use.
+"""
+
+from __future__ import (
+    unicode_literals,
+    print_function,
+    absolute_import,
+    division,
+    )
+
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+
+__all__ = ['worker_pools_from_settings', 'WorkerPools']
+
+
+class WorkerPools(object):
+    """Lazily constructs a thread pool and a process pool"""
+
+    def __init__(self, threads=4, processes=None):
+        if threads < 1:
+            raise ValueError('At least one worker thread is required')
+        self._threads_count = threads
+        self._processes_count = processes
+        self._threads = None
+        self._processes = None
+        self._lock = threading.Lock()
+
+    @property
+    def threads(self):
+        """Returns the pool of worker threads"""
+        with self._lock:
+            if self._threads is None:
+                self._threads = ThreadPool(self._threads_count)
+            return self._threads
+
+    @property
+    def processes(self):
+        """
+        Returns the pool of worker processes, or None if background processing
+        has been disabled (in which case work is deferred until it is needed)
+        """
+        if self._processes_count == 0:
+            return None
+        with self._lock:
+            if self._processes is None:
+                self._processes = multiprocessing.Pool(self._processes_count)
+            return self._processes
+
+    def start(self):
+        """Forks the pool of worker processes now rather than on first use"""
+        self.processes
+
+    def close(self):
+        """Waits for all outstanding work and shuts down the pools"""
+        with self._lock:
+            for pool in (self._threads, self._processes):
+                if pool is not None:
+                    pool.close()
+                    pool.join()
+            self._threads = None
+            self._processes = None
+
+
+def worker_pools_from_settings(settings):
+    """
+    Return a WorkerPools instance using settings supplied from a Paste
+    configuration file
+    """
+    processes = settings.get('workers.processes')
+    return WorkerPools(
+        threads=int(settings.get('workers.threads', 4)),
+        processes=int(processes) if processes is not None else None)
@@ -93,6 +93,10 @@ ENTRY_POINTS = """\
 
     [console_scripts]
     initialize_samplesdb_db = samplesdb.scripts.initializedb:main
+    migrate_samplesdb_attachments = samplesdb.scripts.migrateattachments:main
+    gc_samplesdb_attachments = samplesdb.scripts.gcattachments:main
+    account_samplesdb_storage = samplesdb.scripts.accountstorage:main
+    import_samplesdb_samples = samplesdb.scripts.importsamples:main
     """
 
 def main():